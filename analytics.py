@@ -0,0 +1,92 @@
+###############
+# analytics.py
+# TOM WRIGHT 2021
+###############
+
+"""
+Detailed analytics of a simulated (or geometrically solved) module, added to the summary analytics when
+ANALYTICS_LEVEL is ANALYTICS_DETAILED in modelParameters.py. Every cell position is read from the module once and
+everything is computed from that snapshot as arrays:
+    cell offsets - final x and y position of every cell relative to its CAD perfect position in the module
+    pitch - x distance between the mean cell offsets of each bandolier and the previous one (nan for the first)
+    tilt - angle (degrees) of the line fitted through the x offsets of a bandolier's cells against their height
+    contacts/penetration - cells of the previous bandolier within ANALYTICS_CONTACT_TOLERANCE of each cell, and how
+                           far each cell overlaps them (contacts with the end constraints are not included)
+The per bandolier values are added to analytics["bandoliers"] (so they are written as columns by multiModel.py),
+and the per cell arrays, shaped (bandolier, cell), to analytics["cells"].
+"""
+
+from typing import Any, Dict
+
+import numpy as np
+
+import components
+import modelParameters
+
+
+# Per cell and per bandolier detailed analytics from a snapshot of cell positions (bandolier, cell, [x, y]) and
+# diameters (bandolier, cell)
+def detailedAnalytics(positions:np.ndarray, diameters:np.ndarray, modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS) -> Dict[str, Any]:
+    xNominal, yNominal = components.nominalCellPositions(modelParams)
+    desiredX = np.arange(len(positions))*modelParams.BANDO_DESIRED_SPACING
+
+    offsetX = positions[..., 0] - desiredX[:, None] - xNominal
+    offsetY = positions[..., 1] - yNominal
+
+    # least squares slope of the x offsets against the cell heights
+    centredX = offsetX - offsetX.mean(axis=1, keepdims=True)
+    centredY = positions[..., 1] - positions[..., 1].mean(axis=1, keepdims=True)
+    tilt = np.degrees(np.arctan(np.sum(centredX*centredY, axis=1)/np.sum(centredY**2, axis=1)))
+
+    meanOffsetX = offsetX.mean(axis=1)
+    pitch = np.concatenate(([np.nan], np.diff(meanOffsetX) + modelParams.BANDO_DESIRED_SPACING))
+
+    contacts = np.zeros(diameters.shape, dtype=int)
+    penetration = np.zeros(diameters.shape)
+    if (len(positions) > 1):
+        gaps = components.neighbourCellGaps(positions, diameters, modelParams)
+        contacts[1:] = np.sum(gaps <= modelParameters.ANALYTICS_CONTACT_TOLERANCE, axis=2)
+        penetration[1:] = np.maximum(0, -gaps.min(axis=2))
+
+    return {
+                "contacts":int(contacts.sum()),
+                "maxPenetration":float(penetration.max()),
+                "bandoliers":[{
+                                "pitchX":float(pitch[i]),
+                                "tilt":float(tilt[i]),
+                                "meanOffsetX":float(meanOffsetX[i]),
+                                "meanOffsetY":float(offsetY[i].mean()),
+                                "contacts":int(contacts[i].sum()),
+                                "maxPenetration":float(penetration[i].max())
+                              } for i in range(len(positions))],
+                "cells":{
+                            "offsetX":offsetX,
+                            "offsetY":offsetY,
+                            "contacts":contacts,
+                            "penetration":penetration
+                        }
+            }
+
+# Add the detailed analytics to summary analytics (as returned by simulationAnalytics) if the level asks for them
+def addDetailedAnalytics(analytics:Dict[str, Any], positions:np.ndarray, diameters:np.ndarray, modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS, level:str = None) -> Dict[str, Any]:
+    if (level is None):
+        level = modelParameters.ANALYTICS_LEVEL
+
+    if (level == modelParameters.ANALYTICS_SUMMARY):
+        return analytics
+    if (level != modelParameters.ANALYTICS_DETAILED):
+        raise ValueError(f"Unknown analytics level {level}")
+
+    detailed = detailedAnalytics(positions, diameters, modelParams)
+
+    analytics["contacts"] = detailed["contacts"]
+    analytics["maxPenetration"] = detailed["maxPenetration"]
+    for bandoAnalysis, bandoDetail in zip(analytics["bandoliers"], detailed["bandoliers"]):
+        bandoAnalysis.update(bandoDetail)
+    analytics["cells"] = detailed["cells"]
+
+    return analytics
+
+
+if __name__ == "__main__":
+    pass
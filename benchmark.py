@@ -0,0 +1,210 @@
+###############
+# benchmark.py
+# TOM WRIGHT 2021
+###############
+
+"""
+This file can be run independantly (headless):
+    python benchmark.py [--full] [--engine geometric] [--save-baseline] [--baseline FILE]
+Benchmarks how module construction and simulation scale with the module size, and how monte-carlo runs scale with
+the number of pool workers:
+    construction - Module() build time
+    simulation - simulateModule steps per second, time to stability and steps to stability
+    pool - model.runSimulation iterations per second for each number of workers
+The module size is varied one parameter at a time around the defaults (BANDO_CELL_COUNT, MODULE_BANDO_COUNT,
+INCLUDE_END_CONSTRAINTS and the 18650/2170/4680 cell presets), or over their full grid with --full. Results are
+written to benchmark.json with the machine they were measured on. With --save-baseline they are also saved as the
+baseline, otherwise they are compared against the baseline and any case more than BENCHMARK_REGRESSION_THRESHOLD
+slower is reported as a regression (the exit code is 1 if there are any).
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+from dataclasses import asdict, replace
+from typing import Any, Dict, List
+
+import numpy as np
+import pymunk
+
+import components
+import execution
+import model
+import modelParameters
+import seeding
+from simulation import simulateModule
+
+BENCHMARK_RESULTS_NAME = "benchmark.json"
+BENCHMARK_BASELINE_NAME = "benchmark_baseline.json"
+BENCHMARK_REGRESSION_THRESHOLD = 0.2 # fraction slower than the baseline that counts as a regression
+
+BENCHMARK_SEED = 0 # modules are sampled from the same seed on every run, so simulations are repeatable
+BENCHMARK_CONSTRUCTION_REPEATS = 5 # the median build time is reported
+BENCHMARK_POOL_ITERATIONS_PER_WORKER = 2
+
+# Module sizes benchmarked, the first value of each is used while the others are varied
+BENCHMARK_CELL_COUNTS = [modelParameters.BANDO_CELL_COUNT, 36, 72]
+BENCHMARK_BANDO_COUNTS = [modelParameters.MODULE_BANDO_COUNT, 3, 6]
+BENCHMARK_END_CONSTRAINTS = [True, False]
+BENCHMARK_CELL_PRESETS = {"18650":modelParameters.CELL_DIAMETER_18650, "2170":modelParameters.CELL_DIAMETER_2170, "4680":modelParameters.CELL_DIAMETER_4680}
+
+# Metrics compared against the baseline, and whether higher is better
+BENCHMARK_METRICS = {"constructionTime":False, "stepsPerSecond":True, "timeToStability":False, "iterationsPerSecond":True}
+
+
+# Model parameters for a cell preset. The bandolier and end constraint geometry is designed around 18650 cells, so
+# it is scaled with the cell diameter
+def presetParameters(preset:str, modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS) -> modelParameters.ModelParams:
+    diameter = BENCHMARK_CELL_PRESETS[preset]
+    scale = diameter/modelParameters.CELL_DIAMETER_18650
+    lengths = ["BANDO_CELL_X", "BANDO_CELL_Y1", "BANDO_CELL_Y2", "BANDO_DESIRED_SPACING",
+               "END_CONSTRAINT_LOWER_X", "END_CONSTRAINT_UPPER_X", "END_CONSTRAINT_LOWER_Y", "END_CONSTRAINT_UPPER_Y",
+               "END_LIMIT_LOWER_X", "END_LIMIT_UPPER_X", "END_LIMIT_LOWER_Y", "END_LIMIT_UPPER_Y"]
+
+    return replace(modelParams, CELL_DIAMETER_CURRENT=diameter, **{name:getattr(modelParams, name)*scale for name in lengths})
+
+# Cases of the benchmark, each a dictionary of the varied parameters (one at a time around the defaults unless full)
+def benchmarkCases(full:bool = False) -> List[Dict[str, Any]]:
+    axes = {"BANDO_CELL_COUNT":BENCHMARK_CELL_COUNTS, "MODULE_BANDO_COUNT":BENCHMARK_BANDO_COUNTS,
+            "INCLUDE_END_CONSTRAINTS":BENCHMARK_END_CONSTRAINTS, "preset":list(BENCHMARK_CELL_PRESETS.keys())}
+
+    if (full):
+        return [dict(zip(axes.keys(), values)) for values in itertools.product(*axes.values())]
+
+    defaults = {name:values[0] for name, values in axes.items()}
+    cases = [defaults]
+    for name, values in axes.items():
+        cases.extend({**defaults, name:value} for value in values[1:])
+
+    return cases
+
+def caseName(case:Dict[str, Any]) -> str:
+    return ",".join(f"{name}={value}" for name, value in case.items())
+
+def caseParameters(case:Dict[str, Any], engine:str = None) -> modelParameters.ModelParams:
+    modelParams = replace(presetParameters(case["preset"]), **{name:value for name, value in case.items() if name != "preset"})
+    if (engine is not None):
+        modelParams = replace(modelParams, SIMULATION_ENGINE=engine)
+
+    return modelParams
+
+
+def benchmarkConstruction(modelParams:modelParameters.ModelParams) -> Dict[str, Any]:
+    times = []
+    for _ in range(BENCHMARK_CONSTRUCTION_REPEATS):
+        start = time.perf_counter()
+        components.Module(modelParams=modelParams, rng=seeding.generator(BENCHMARK_SEED))
+        times.append(time.perf_counter()-start)
+
+    return {"constructionTime":float(np.median(times))}
+
+def benchmarkSimulation(modelParams:modelParameters.ModelParams) -> Dict[str, Any]:
+    module = components.Module(modelParams=modelParams, rng=seeding.generator(BENCHMARK_SEED))
+
+    start = time.perf_counter()
+    stable = simulateModule(module, includeProgressBar=False)
+    duration = time.perf_counter()-start
+
+    return {"stable":bool(stable), "steps":module.simulationSteps, "stepsPerSecond":module.simulationSteps/duration,
+            "timeToStability":duration if stable else None, "bodies":len(module.space.bodies), "constraints":len(module.space.constraints)}
+
+# Iterations per second of model.runSimulation with each number of workers (powers of two up to the CPU count)
+def benchmarkPool(engine:str = None) -> List[Dict[str, Any]]:
+    workerCounts = sorted({min(2**i, os.cpu_count() or 1) for i in range(int(np.log2(os.cpu_count() or 1))+2)})
+    processes = modelParameters.POOL_PROCESSES
+    results = []
+
+    try:
+        for workers in workerCounts:
+            execution.shutdownPool()
+            modelParameters.POOL_PROCESSES = workers
+            execution.getPool([model.runParameters(engine)])
+
+            numIterations = BENCHMARK_POOL_ITERATIONS_PER_WORKER*workers
+            start = time.perf_counter()
+            model.runSimulation(numIterations, displayResults=False, engine=engine, seed=BENCHMARK_SEED)
+            duration = time.perf_counter()-start
+
+            results.append({"benchmark":"pool", "case":f"workers={workers}", "workers":workers, "iterations":numIterations, "iterationsPerSecond":numIterations/duration})
+    finally:
+        execution.shutdownPool()
+        modelParameters.POOL_PROCESSES = processes
+
+    return results
+
+def runBenchmarks(full:bool = False, engine:str = None, includePool:bool = True) -> Dict[str, Any]:
+    results = []
+    for case in benchmarkCases(full):
+        modelParams = caseParameters(case)
+        print(f"Benchmarking {caseName(case)}")
+
+        results.append({"benchmark":"construction", "case":caseName(case), **case, **benchmarkConstruction(modelParams)})
+        results.append({"benchmark":"simulation", "case":caseName(case), **case, **benchmarkSimulation(modelParams)})
+
+    if (includePool):
+        results.extend(benchmarkPool(engine))
+
+    return {
+                "machine":{"platform":platform.platform(), "processor":platform.processor(), "cpuCount":os.cpu_count(),
+                           "python":platform.python_version(), "numpy":np.__version__, "pymunk":pymunk.version},
+                "time":time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "defaults":asdict(modelParameters.DEFAULT_PARAMETERS),
+                "results":results
+            }
+
+
+# Compare benchmark results against a baseline. Returns a row per metric of every case in both, with the ratio
+# of the new value to the baseline and whether it is a regression
+def compareBenchmarks(results:Dict[str, Any], baseline:Dict[str, Any], threshold:float = BENCHMARK_REGRESSION_THRESHOLD) -> List[Dict[str, Any]]:
+    baselineResults = {(x["benchmark"], x["case"]):x for x in baseline["results"]}
+    comparison = []
+
+    for result in results["results"]:
+        previous = baselineResults.get((result["benchmark"], result["case"]))
+        if (previous is None):
+            continue
+
+        for metric, higherIsBetter in BENCHMARK_METRICS.items():
+            if (result.get(metric) is None or previous.get(metric) is None):
+                continue
+
+            ratio = result[metric]/previous[metric]
+            slowdown = 1/ratio - 1 if higherIsBetter else ratio - 1
+            comparison.append({"benchmark":result["benchmark"], "case":result["case"], "metric":metric, "baseline":previous[metric],
+                               "value":result[metric], "ratio":ratio, "regression":slowdown > threshold})
+
+    return comparison
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Module construction and simulation benchmarks")
+    parser.add_argument("--full", action="store_true", help="benchmark the full grid of module sizes")
+    parser.add_argument("--engine", default=None, help="simulation engine of the pool benchmark")
+    parser.add_argument("--no-pool", action="store_true", help="skip the pool benchmark")
+    parser.add_argument("--baseline", default=BENCHMARK_BASELINE_NAME)
+    parser.add_argument("--save-baseline", action="store_true")
+    args = parser.parse_args()
+
+    results = runBenchmarks(args.full, args.engine, not args.no_pool)
+    with open(BENCHMARK_RESULTS_NAME, 'w') as file:
+        json.dump(results, file, indent=4)
+
+    if (args.save_baseline):
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=4)
+        print(f"Saved baseline to {args.baseline}")
+    elif (os.path.exists(args.baseline)):
+        with open(args.baseline) as file:
+            comparison = compareBenchmarks(results, json.load(file))
+
+        for row in comparison:
+            print(f"{'REGRESSION' if row['regression'] else 'ok':>10} {row['benchmark']:>12} {row['metric']:>20} {row['ratio']:6.2f}x  {row['case']}")
+
+        if (any(row["regression"] for row in comparison)):
+            sys.exit(1)
+    else:
+        print(f"No baseline at {args.baseline}, run with --save-baseline to create one")
@@ -11,24 +11,118 @@ some initial distance between bandoliers must be set, by default this is minimis
 needed. All other paremeters of cell spacing, cell count, bandolier count, etc are set in modelParameters.py.
 """
 
-from typing import List, Tuple
+import atexit
+from typing import Dict, List, Optional, Tuple
 import pymunk
 from dataclasses import dataclass, field
 
 import modelParameters
+import profiling
+import seeding
 from endConstraints import EndConstraint, EndLimit
 
 import numpy as np
-import matplotlib.pyplot as plt
+
+STARTING_DISTANCE_FROM_END_CONSTRAINT = 1 # mm. With end constraints, a bandolier starts at least this far past its desired position
 
 # Set up simulation space with arbitary gravity and low damping
-def setupSpace() -> pymunk.Space:
+def setupSpace(modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS) -> pymunk.Space:
     space = pymunk.Space()
     space.gravity = -1000,0
     space.damping = 0.00000000000000000000000001
+
+    if (modelParams.MODEL_SLEEP_ENABLED):
+        space.sleep_time_threshold = modelParams.MODEL_SLEEP_TIME_THRESHOLD
+        space.idle_speed_threshold = modelParams.MODEL_SLEEP_IDLE_SPEED
+
+    if (modelParams.MODEL_BROADPHASE == modelParameters.BROADPHASE_SPATIAL_HASH):
+        space.use_spatial_hash(*spatialHashDimensions(modelParams))
+    elif (modelParams.MODEL_BROADPHASE != modelParameters.BROADPHASE_BBTREE):
+        raise ValueError(f"Unknown broad-phase {modelParams.MODEL_BROADPHASE}")
     
     return space
 
+# Cell size (mm) and number of cells of the spatial hash. Cells are about the size of a battery cell, so each shape
+# only covers a few hash cells, and there are enough hash cells to cover the whole module (pymunk recommends at least
+# ten times the number of shapes) so that distant shapes rarely share one
+def spatialHashDimensions(modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS) -> Tuple[float, int]:
+    dimension = max(modelParams.CELL_DIAMETER_CURRENT, modelParams.BANDO_CELL_Y2/2)
+
+    moduleWidth = modelParams.MODULE_BANDO_COUNT*max(modelParams.BANDO_DESIRED_SPACING, abs(modelParams.BANDO_CELL_X)+dimension) + dimension
+    moduleHeight = (modelParams.BANDO_CELL_COUNT/2)*modelParams.BANDO_CELL_Y2 + 2*dimension
+    if (modelParams.INCLUDE_END_CONSTRAINTS):
+        moduleHeight += max(modelParams.END_LIMIT_LOWER_Y, modelParams.END_CONSTRAINT_LOWER_Y) + max(modelParams.END_LIMIT_UPPER_Y, modelParams.END_CONSTRAINT_UPPER_Y)
+
+    shapeCount = modelParams.MODULE_BANDO_COUNT*(modelParams.BANDO_CELL_COUNT+4)
+    count = max(10*shapeCount, int(np.ceil(moduleWidth/dimension)*np.ceil(moduleHeight/dimension)))
+
+    return (dimension, count)
+
+# Collision topology. A bandolier can only touch its neighbours, so the cells of bandolier k are in collision category
+# k%4 and only collide with categories (k-1)%4 and (k+1)%4. This filters out every other bandolier except those at a
+# period of 3: (k+3)%4 is (k-1)%4, so bandoliers k and k±3 could also collide. They never do, as the two bandoliers
+# between them keep them apart (the cells of bandolier k can not pass through those of k±1), so their bounding boxes
+# do not overlap and the broad-phase does not pair them. Bandoliers k and k±4 share a category, which never collides
+# with itself, so cells of the same bandolier never collide either. The end constraints and end limits of bandolier k
+# only collide with each other, on category 4 + k%4. This works for any number of bandoliers
+COLLISION_CELL_CATEGORIES = 4
+COLLISION_END_STOP_FIRST_CATEGORY = 4
+
+def cellCollisionFilter(bandoId:int) -> pymunk.ShapeFilter:
+    category = 1 << (bandoId%COLLISION_CELL_CATEGORIES)
+    mask = (1 << ((bandoId-1)%COLLISION_CELL_CATEGORIES)) | (1 << ((bandoId+1)%COLLISION_CELL_CATEGORIES))
+
+    return pymunk.ShapeFilter(categories=category, mask=mask)
+
+def endStopCollisionFilter(bandoId:int) -> pymunk.ShapeFilter:
+    category = 1 << (COLLISION_END_STOP_FIRST_CATEGORY + bandoId%COLLISION_CELL_CATEGORIES)
+
+    return pymunk.ShapeFilter(categories=category, mask=category)
+
+# CAD perfect (x, y) positions of the cells in a bandolier
+def nominalCellPositions(modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS) -> Tuple[np.ndarray, np.ndarray]:
+    cellIds = np.arange(modelParams.BANDO_CELL_COUNT)
+
+    xNominal = (cellIds%2) * modelParams.BANDO_CELL_X
+    yNominal = np.where(cellIds%2 == 0, (cellIds/2)*modelParams.BANDO_CELL_Y2, ((cellIds-1)/2)*modelParams.BANDO_CELL_Y2 + modelParams.BANDO_CELL_Y1)
+
+    return (xNominal, yNominal)
+
+# Gaps (mm) between the cells of neighbouring bandoliers, negative where cells overlap. positions are (bandolier, cell,
+# [x, y]) and diameters (bandolier, cell). Cells are ordered by height, so each cell is only compared against the
+# cells of the previous bandolier with nearby indices. Returns (bandolier-1, cell, offset) gaps between cell j of
+# bandolier i+1 and cell j+offset of bandolier i, inf where there is no such cell
+def neighbourCellGaps(positions:np.ndarray, diameters:np.ndarray, modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS) -> np.ndarray:
+    minYPitch = min(modelParams.BANDO_CELL_Y1, modelParams.BANDO_CELL_Y2-modelParams.BANDO_CELL_Y1)
+    window = int(np.ceil(diameters.max()/max(minYPitch, 1e-9))) + 1
+
+    cellCount = diameters.shape[1]
+    partners = np.arange(cellCount)[:, None] + np.arange(-window, window+1)[None, :]
+    valid = (partners >= 0) & (partners < cellCount)
+    partners = np.clip(partners, 0, cellCount-1)
+
+    separations = positions[1:, :, None, :] - positions[:-1][:, partners, :]
+    gaps = np.hypot(separations[..., 0], separations[..., 1]) - (diameters[1:, :, None]+diameters[:-1][:, partners])/2
+
+    return np.where(valid, gaps, np.inf)
+
+# Total width (mm) of a module from its cell x positions and diameters, both shaped (bandolier, cell): from the
+# leftmost cell centre of the first bandolier to the rightmost of the last, plus a cell diameter
+def moduleWidth(xPositions:np.ndarray, diameters:np.ndarray) -> float:
+    return float(xPositions[-1].max() - xPositions[0].min() + diameters[0][0])
+
+# Random variation in cell position and diameter of a bandolier, drawn from rng (a newly seeded generator if not
+# given). Returns the x and y offsets and the cell diameters
+def sampleCellTolerances(modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS, rng:Optional[np.random.Generator] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    if (rng is None):
+        rng = seeding.generator()
+
+    xTolerances = rng.normal(modelParams.BANDO_X_MU, modelParams.BANDO_X_SIGMA, modelParams.BANDO_CELL_COUNT)
+    yTolerances = rng.normal(modelParams.BANDO_Y_MU, modelParams.BANDO_Y_SIGMA, modelParams.BANDO_CELL_COUNT)
+    diameterTolerances = modelParams.CELL_DIAMETER_CURRENT + rng.normal(modelParams.CELL_DIAMETER_MU, modelParams.CELL_DIAMETER_SIGMA, modelParams.BANDO_CELL_COUNT)
+
+    return (xTolerances, yTolerances, diameterTolerances)
+
 # Definition of Cell class containing cell id (working from lowest cell to highest cell) and its positions
 @dataclass
 class Cell:
@@ -95,6 +189,18 @@ class Cell:
     def setFilter(self, category:int, mask:int) -> None:
         self.shape.filter = pymunk.ShapeFilter(categories=category, mask=mask)
 
+    # Re-use the cell with new tolerances, putting it back at its start position at rest
+    def reset(self, xOffset:float, yOffset:float, cellDiameter:float) -> None:
+        self.xOffset = xOffset
+        self.yOffset = yOffset
+        self.cellDiameter = cellDiameter
+
+        self.shape.unsafe_set_radius(cellDiameter/2)
+        self.body.position = (self.xPosition, self.yPosition)
+        self.body.velocity = (0, 0)
+        self.body.angle = 0
+        self.body.angular_velocity = 0
+
 # class definition of Bandolier to handle collections of cells and end constraints
 @dataclass
 class Bandolier:
@@ -104,11 +210,16 @@ class Bandolier:
     y: float = 0
     static:bool = False
     modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS
+    tolerances:Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None # (x offsets, y offsets, diameters), sampled if not given
+    rng:Optional[np.random.Generator] = None # random stream the tolerances are sampled from
 
     def __post_init__(self) -> None:
         self.desiredX:float = self.id*self.modelParams.BANDO_DESIRED_SPACING
 
         self.colour:Tuple[int, int, int, int] = modelParameters.COLOUR_ALL[self.id%(len(modelParameters.COLOUR_ALL))]
+        self.joints:List[pymunk.Constraint] = []
+        self.frozen:bool = False # set once the bandolier has been settled and converted to static bodies
+        self.frozenMasses:List[Tuple[float, float]] = [] # (mass, moment) of each dynamic body before freezing
         
         self.createCells()
 
@@ -122,31 +233,36 @@ class Bandolier:
     def createCells(self) -> None:
         self.cells:List[Cell] = []
 
-        xTolerances = np.random.normal(self.modelParams.BANDO_X_MU, self.modelParams.BANDO_X_SIGMA, self.modelParams.BANDO_CELL_COUNT)
-        yTolerances = np.random.normal(self.modelParams.BANDO_Y_MU, self.modelParams.BANDO_Y_SIGMA, self.modelParams.BANDO_CELL_COUNT)
-        diameterTolerances = self.modelParams.CELL_DIAMETER_CURRENT + np.random.normal(self.modelParams.CELL_DIAMETER_MU, self.modelParams.CELL_DIAMETER_SIGMA, self.modelParams.BANDO_CELL_COUNT)
+        if (self.tolerances is None):
+            self.tolerances = sampleCellTolerances(self.modelParams, self.rng)
+
+        # the cells of a bandolier are also held as arrays (one element per cell) for the batch getters below
+        self.xNominal:np.ndarray
+        self.yNominal:np.ndarray
+        self.xNominal, self.yNominal = nominalCellPositions(self.modelParams)
+        self.xOffsets:np.ndarray
+        self.yOffsets:np.ndarray
+        self.diameters:np.ndarray
+        self.xOffsets, self.yOffsets, self.diameters = self.tolerances
+
         for i in range(self.modelParams.BANDO_CELL_COUNT):
-            xPos = i%2 * self.modelParams.BANDO_CELL_X
-            
-            if (i%2 == 0):
-                yPos = (i/2)*self.modelParams.BANDO_CELL_Y2
-            else:
-                yPos = ((i-1)/2)*self.modelParams.BANDO_CELL_Y2 + self.modelParams.BANDO_CELL_Y1
-            
             newCell = Cell(i,
-                xTolerances[i],
-                yTolerances[i],
-                xPos,
-                yPos,
+                self.xOffsets[i],
+                self.yOffsets[i],
+                self.xNominal[i],
+                self.yNominal[i],
                 self.x,
                 self.y,
                 self.space,
-                diameterTolerances[i],
+                self.diameters[i],
                 self.static,
                 self.colour,
                 self.modelParams)
+            newCell.shape.filter = cellCollisionFilter(self.id)
 
             self.cells.append(newCell)
+
+        self.bodies:List[pymunk.Body] = [cell.body for cell in self.cells]
     
     def setupEndConstraints(self) ->None:
         self.lowerConstraint = EndConstraint(self.modelParams.END_CONSTRAINT_LOWER_X,
@@ -194,19 +310,21 @@ class Bandolier:
             joint1 = pymunk.PinJoint(self.cells[i].body,self.cells[i+1].body)
 
             self.space.add(joint1)
+            self.joints.append(joint1)
             if i != self.modelParams.BANDO_CELL_COUNT-2:
                 joint2 = pymunk.PinJoint(self.cells[i].body,self.cells[i+2].body)
 
                 self.space.add(joint2)
+                self.joints.append(joint2)
     
     def constrainBando(self) -> None:
+        collisionFilter = endStopCollisionFilter(self.id)
 
-        category = 2**self.id
-        self.upperConstraint.setFilter(category, category)
-        self.lowerConstraint.setFilter(category, category)
+        self.upperConstraint.setFilter(collisionFilter.categories, collisionFilter.mask)
+        self.lowerConstraint.setFilter(collisionFilter.categories, collisionFilter.mask)
 
-        self.upperLimit.setFilter(category, category)
-        self.lowerLimit.setFilter(category, category)
+        self.upperLimit.setFilter(collisionFilter.categories, collisionFilter.mask)
+        self.lowerLimit.setFilter(collisionFilter.categories, collisionFilter.mask)
     
     def distanceFromUpperLimit(self) -> Tuple[float, float]:
         if (not self.modelParams.INCLUDE_END_CONSTRAINTS):
@@ -222,17 +340,152 @@ class Bandolier:
         limitPos = (self.desiredX+self.modelParams.END_LIMIT_LOWER_X, self.cells[0].yNominal-self.modelParams.END_LIMIT_LOWER_Y)
         return tuple(np.subtract(self.lowerConstraint.body.position, limitPos))
 
+    # (x, y) start positions of every cell in the bandolier (before simulation)
+    def getStartPositions(self) -> np.ndarray:
+        return np.column_stack((self.x + self.xNominal + self.xOffsets, self.y + self.yNominal + self.yOffsets))
+
+    # x velocities of every cell in the bandolier, read in a single pass
+    def getXVelocities(self) -> np.ndarray:
+        return np.fromiter((body.velocity.x for body in self.bodies), dtype=float, count=len(self.bodies))
+
+    # (x, y) velocities of every cell in the bandolier, read in a single pass
+    def getVelocities(self) -> np.ndarray:
+        return np.fromiter((component for body in self.bodies for component in body.velocity), dtype=float, count=2*len(self.bodies)).reshape(-1, 2)
+
+    # (x, y) simulation positions of every cell in the bandolier, read in a single pass
+    def getPositions(self) -> np.ndarray:
+        return np.fromiter((coord for body in self.bodies for coord in body.position), dtype=float, count=2*len(self.bodies)).reshape(-1, 2)
+
+    # (x, y, angle) of every dynamic body in the bandolier (ordered as getDynamicBodies())
+    def getBodyStates(self) -> np.ndarray:
+        bodies = self.getDynamicBodies()
+
+        return np.fromiter((value for body in bodies for value in (*body.position, body.angle)), dtype=float, count=3*len(bodies)).reshape(-1, 3)
+
+    # Move the dynamic bodies to (x, y, angle) states as returned by getBodyStates(). Joints are not updated
+    def setBodyStates(self, states:np.ndarray) -> None:
+        for body, (x, y, angle) in zip(self.getDynamicBodies(), states.tolist()):
+            body.position = (x, y)
+            body.angle = angle
+            self.space.reindex_shapes_for_body(body)
+
+    # Bodies moved by the simulation (cells and the end constraints attached to them)
+    def getDynamicBodies(self) -> List[pymunk.Body]:
+        bodies = [cell.body for cell in self.cells]
+
+        if (self.modelParams.INCLUDE_END_CONSTRAINTS):
+            bodies.extend([self.lowerConstraint.body, self.upperConstraint.body])
+
+        return bodies
+
+    def getJoints(self) -> List[pymunk.Constraint]:
+        joints = list(self.joints)
+
+        if (self.modelParams.INCLUDE_END_CONSTRAINTS):
+            joints.extend(self.lowerConstraint.joints + self.upperConstraint.joints)
+
+        return joints
+
+    def getShapes(self) -> List[pymunk.Shape]:
+        shapes = [cell.shape for cell in self.cells]
+
+        if (self.modelParams.INCLUDE_END_CONSTRAINTS):
+            shapes.extend([self.lowerConstraint.shape, self.upperConstraint.shape])
+
+        return shapes
+
+    # Take the bandolier out of the simulation space (end limits are static and stay in the space)
+    def removeFromSpace(self) -> None:
+        self.space.remove(*self.getJoints(), *self.getShapes(), *self.getDynamicBodies())
+
+    def addToSpace(self) -> None:
+        self.space.add(*self.getDynamicBodies(), *self.getShapes(), *self.getJoints())
+
+    # Convert a settled bandolier to static bodies so it no longer costs solver time
+    def freeze(self) -> None:
+        if (self.static or self.frozen):
+            return
+
+        self.space.remove(*self.getJoints())
+        self.frozenMasses = []
+        for body in self.getDynamicBodies():
+            self.frozenMasses.append((body.mass, body.moment))
+            body.velocity = (0, 0)
+            body.angular_velocity = 0
+            body.body_type = pymunk.Body.STATIC
+
+        self.frozen = True
+
+    # Re-randomise the bandolier (new tolerances are sampled from rng if not given), moving the cells and end constraints
+    # back to their start positions at rest. Only used by Module.reset, while the bandolier is out of the space
+    def reset(self, tolerances:Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None, rng:Optional[np.random.Generator] = None) -> None:
+        # the shapes carry no mass, so the body masses have to be restored after freezing
+        if (self.frozen):
+            for body, (mass, moment) in zip(self.getDynamicBodies(), self.frozenMasses):
+                body.body_type = pymunk.Body.DYNAMIC
+                body.mass = mass
+                body.moment = moment
+            self.frozen = False
+
+        self.rng = rng
+        if (tolerances is None):
+            tolerances = sampleCellTolerances(self.modelParams, self.rng)
+        self.tolerances = tolerances
+
+        self.xOffsets, self.yOffsets, self.diameters = self.tolerances
+        for cell, xOffset, yOffset, diameter in zip(self.cells, self.xOffsets, self.yOffsets, self.diameters):
+            cell.reset(xOffset, yOffset, diameter)
+
+        if (self.modelParams.INCLUDE_END_CONSTRAINTS):
+            self.lowerConstraint.reset()
+            self.upperConstraint.reset()
+
+    # Joints for the current cell positions, in the same order as when the bandolier was built
+    def createJoints(self) -> None:
+        self.joints = []
+
+        if (self.modelParams.INCLUDE_END_CONSTRAINTS):
+            self.lowerConstraint.createJoints()
+            self.upperConstraint.createJoints()
+
+        if (not self.static):
+            self.constrainCells()
+
     def updatePosition(self) -> None:
         for cell in self.cells:
             cell.setStart(self.x, self.y)
+
+    # Move the start position of the bandolier (taking effect when it is next reset)
+    def setOrigin(self, x:float) -> None:
+        self.x = x
+        for cell in self.cells:
+            cell.xStart = x
+
+        if (self.modelParams.INCLUDE_END_CONSTRAINTS):
+            self.lowerConstraint.xStart = x
+            self.upperConstraint.xStart = x
+
+    # x origin the bandolier has settled at (the mean over its cells, which may also have moved relative to each other)
+    def settledOrigin(self) -> float:
+        return float(np.mean(self.getPositions()[:, 0] - self.xNominal - self.xOffsets))
             
 
+# Tolerances are sampled from rng (a newly seeded generator if not given) unless they are given. bandoOrigins are the
+# x origins of the bandoliers to start from instead of the loose initial layout (see warmStartOrigins)
 class Module:
-    def __init__(self,initialBandolierSpacing:int = 0, modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS) -> None:
+    def __init__(self,initialBandolierSpacing:int = 0, modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS, tolerances:Optional[List[Tuple[np.ndarray, np.ndarray, np.ndarray]]] = None, rng:Optional[np.random.Generator] = None, bandoOrigins:Optional[List[float]] = None) -> None:
         self.bandoliers:List[Bandolier] = []
-        self.space:pymunk.Space = setupSpace()
-        self.simulated = False
+        self.initialOrigins:List[float] = [] # x origins of the loose initial layout
+        self.rng:np.random.Generator = rng if rng is not None else seeding.generator()
         self.modelParams:modelParameters.ModelParams = modelParams
+        self.space:pymunk.Space = setupSpace(self.modelParams)
+        self.simulated = False
+        self.simulationSteps:int = 0 # number of physics steps taken by the last simulation
+        self.simulatedTime:float = 0 # simulated time (s) covered by the last simulation
+        self.sleepingBodies:int = 0 # number of dynamic bodies asleep at the end of the last simulation
+        self.firstSleepStep:int = -1 # step at which the first body fell asleep (-1 if none did)
+        self.allAsleepStep:int = -1 # step at which every dynamic body was asleep (-1 if they never were)
+        self.abortReason:str = "" # why the last simulation was aborted early ("" if it was not, see convergence.DivergenceMonitor)
         self.numBandos:int = self.modelParams.MODULE_BANDO_COUNT
 
 
@@ -245,9 +498,12 @@ class Module:
 
             xBandoOrigin = i*(abs(self.modelParams.BANDO_CELL_X) + xMinimalSpacingOfset + initialBandolierSpacing)
             
-            startingDistanceFromEndConstraint = 1 #mm 
-            if (i != 0 and self.modelParams.INCLUDE_END_CONSTRAINTS and xBandoOrigin < i*self.modelParams.BANDO_DESIRED_SPACING+startingDistanceFromEndConstraint):
-                xBandoOrigin = i*self.modelParams.BANDO_DESIRED_SPACING+startingDistanceFromEndConstraint
+            if (i != 0 and self.modelParams.INCLUDE_END_CONSTRAINTS and xBandoOrigin < i*self.modelParams.BANDO_DESIRED_SPACING+STARTING_DISTANCE_FROM_END_CONSTRAINT):
+                xBandoOrigin = i*self.modelParams.BANDO_DESIRED_SPACING+STARTING_DISTANCE_FROM_END_CONSTRAINT
+
+            self.initialOrigins.append(xBandoOrigin)
+            if (bandoOrigins is not None and i != 0):
+                xBandoOrigin = bandoOrigins[i]
             
             yBandoOrigin = 0
 
@@ -256,44 +512,160 @@ class Module:
             else:
                 static = False
 
-            self.bandoliers.append(Bandolier(i, self.space, xBandoOrigin, yBandoOrigin, static,self.modelParams))
+            bandoTolerances = None if tolerances is None else tolerances[i]
+
+            self.bandoliers.append(Bandolier(i, self.space, xBandoOrigin, yBandoOrigin, static,self.modelParams, bandoTolerances, self.rng))
+
+        # order the bodies and shapes were added to the space in (see reset)
+        self.builtBodies:List[pymunk.Body] = list(self.space.bodies)
+        self.builtShapes:List[pymunk.Shape] = list(self.space.shapes)
     
+    # Re-randomise the module in place for another monte-carlo iteration. Everything is taken out of the space and
+    # added back in the order it was built, with new joints, so no contacts or joint impulses are carried over from
+    # the last simulation and the module simulates exactly as a newly built one with the same tolerances would
+    def reset(self, tolerances:Optional[List[Tuple[np.ndarray, np.ndarray, np.ndarray]]] = None, rng:Optional[np.random.Generator] = None, bandoOrigins:Optional[List[float]] = None) -> None:
+        self.space.remove(*self.space.constraints, *self.space.shapes, *self.space.bodies)
+
+        origins = self.initialOrigins if bandoOrigins is None else [self.initialOrigins[0]] + list(bandoOrigins[1:])
+
+        self.rng = rng if rng is not None else seeding.generator()
+        for i, bando in enumerate(self.bandoliers):
+            bando.setOrigin(origins[i])
+            bando.reset(None if tolerances is None else tolerances[i], self.rng)
+
+        self.space.add(*self.builtBodies, *self.builtShapes)
+        for bando in self.bandoliers:
+            bando.createJoints()
+
+        self.simulated = False
+        self.simulationSteps = 0
+        self.simulatedTime = 0
+        self.sleepingBodies = 0
+        self.firstSleepStep = -1
+        self.allAsleepStep = -1
+        self.abortReason = ""
+
+    # x origins the bandoliers have settled at (see warmStartOrigins)
+    def getSettledOrigins(self) -> List[float]:
+        return [bando.settledOrigin() for bando in self.bandoliers]
+
+    # Every dynamic body of the bandoliers that are simulated (the first bandolier is static)
+    def getDynamicBodies(self) -> List[pymunk.Body]:
+        return [body for bando in self.bandoliers if not bando.static for body in bando.getDynamicBodies()]
+
+    # Smallest gap (mm) between the cells of each bandolier of ids and the bandolier before it, negative where cells
+    # overlap. Every bandolier after the first is measured if ids is not given
+    def getNeighbourClearances(self, ids:Optional[List[int]] = None) -> np.ndarray:
+        if (ids is None):
+            ids = list(range(1, self.numBandos))
+
+        if (len(ids) == 0):
+            return np.zeros(0)
+
+        # bandoliers are laid out in (below, above) pairs, so every other gap is within a pair
+        pairs = [self.bandoliers[i] for id in ids for i in (id-1, id)]
+        positions = np.stack([bando.getPositions() for bando in pairs])
+        diameters = np.stack([bando.diameters for bando in pairs])
+
+        return neighbourCellGaps(positions, diameters, self.modelParams)[::2].min(axis=(1, 2))
+
+    # Cell diameters, shaped (bandolier, cell)
+    def getDiameters(self) -> np.ndarray:
+        return np.stack([bando.diameters for bando in self.bandoliers])
+
+    # (x, y) distances of the lower and upper end constraints of every bandolier from their end limits, each shaped
+    # (bandolier, 2). Zero if the module has no end constraints
+    def getLimitDistances(self) -> Tuple[np.ndarray, np.ndarray]:
+        if (not self.modelParams.INCLUDE_END_CONSTRAINTS):
+            return (np.zeros((self.numBandos, 2)), np.zeros((self.numBandos, 2)))
+
+        _, yNominal = nominalCellPositions(self.modelParams)
+        desiredX = np.array([bando.desiredX for bando in self.bandoliers])
+
+        lowerPositions = np.array([tuple(bando.lowerConstraint.body.position) for bando in self.bandoliers])
+        upperPositions = np.array([tuple(bando.upperConstraint.body.position) for bando in self.bandoliers])
+        lowerLimits = np.column_stack((desiredX+self.modelParams.END_LIMIT_LOWER_X, np.full(self.numBandos, yNominal[0]-self.modelParams.END_LIMIT_LOWER_Y)))
+        upperLimits = np.column_stack((desiredX+self.modelParams.END_LIMIT_UPPER_X, np.full(self.numBandos, yNominal[-1]+self.modelParams.END_LIMIT_UPPER_Y)))
+
+        return (lowerPositions-lowerLimits, upperPositions-upperLimits)
+
+    # (x, y) simulation positions of every cell, shaped (bandolier, cell, 2)
+    def getPositions(self) -> np.ndarray:
+        return np.stack([bando.getPositions() for bando in self.bandoliers])
+
+    # (x, y) velocities of every cell, shaped (bandolier, cell, 2)
+    def getVelocities(self) -> np.ndarray:
+        return np.stack([bando.getVelocities() for bando in self.bandoliers])
+
+    # (x, y, angle) of every bandolier body, shaped (bandolier, body, 3) (see Bandolier.getBodyStates)
+    def getBodyStates(self) -> np.ndarray:
+        return np.stack([bando.getBodyStates() for bando in self.bandoliers])
+
+    def setBodyStates(self, states:np.ndarray) -> None:
+        for bando, bandoStates in zip(self.bandoliers, states):
+            bando.setBodyStates(bandoStates)
+
+    # Extent of the cell centres, from the left of the first bandolier to the right of the last and from the lowest
+    # bottom cell to the highest top cell. Returns (left, right, bottom, top)
+    def getCellBounds(self) -> Tuple[float, float, float, float]:
+        positions = self.getPositions()
+
+        return (positions[0, :, 0].min(), positions[-1, :, 0].max(), positions[:, 0, 1].min(), positions[:, -1, 1].max())
+
     def getTotalWidth(self) -> float: #mm
         if (not self.simulated):
             return -1
-        
-        leftMostX = min([cell.simXPos for cell in self.bandoliers[0].cells])
-        rightMostX = max([cell.simXPos for cell in self.bandoliers[-1].cells])
 
-        return rightMostX-leftMostX+self.bandoliers[0].cells[0].cellDiameter
+        xPositions = [self.bandoliers[0].getPositions()[:, 0], self.bandoliers[-1].getPositions()[:, 0]]
+
+        return moduleWidth(xPositions, [self.bandoliers[0].diameters])
     
+    # Draw the module (see visualisation.py, matplotlib is only imported when a module is displayed)
     def displayModule(self, title:str="", blocking:bool=True)->None:
-        leftMostX = min([cell.simXPos for cell in self.bandoliers[0].cells])
-        rightMostX = max([cell.simXPos for cell in self.bandoliers[-1].cells])
-        bottomMostY = min([bando.cells[0].simYPos for bando in self.bandoliers])
-        topMostY = max([bando.cells[-1].simYPos for bando in self.bandoliers])
-
-        if self.modelParams.INCLUDE_END_CONSTRAINTS:
-            bottomMostY -= max(self.modelParams.END_LIMIT_LOWER_Y, self.modelParams.END_CONSTRAINT_LOWER_Y)
-            topMostY += max(self.modelParams.END_LIMIT_UPPER_Y, self.modelParams.END_CONSTRAINT_UPPER_Y)
-
-        figureXLim = (leftMostX-25, rightMostX+25)
-        figureYLim = (bottomMostY-25, topMostY+25)
-        
-        fig = plt.figure()
-        ax = plt.axes(xlim=figureXLim, ylim=figureYLim)
-        plt.title(title)
-        ax.set_aspect("equal")
-
-        drawOption = pymunk.matplotlib_util.DrawOptions(ax)
-        drawOption.flags = pymunk.SpaceDebugDrawOptions.DRAW_SHAPES | \
-                            pymunk.SpaceDebugDrawOptions.DRAW_COLLISION_POINTS | \
-                            (pymunk.SpaceDebugDrawOptions.DRAW_CONSTRAINTS if modelParameters.DISPLAY_CONSTRAINTS else 0)
-        self.space.debug_draw(drawOption)
-        
-        if (blocking):
-            plt.show()
-
+        import visualisation
+        visualisation.displayModule(self, title, blocking)
+
+
+# Start origins for a module warm started from the settled origins of a similar module. Each bandolier is moved
+# MODEL_WARM_START_CLEARANCE further from the first than the previous one, and no closer to its end limits than in
+# the loose initial layout
+def warmStartOrigins(settledOrigins:List[float], modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS) -> List[float]:
+    origins = [settledOrigins[0]]
+    for i, settledOrigin in enumerate(settledOrigins[1:], 1):
+        origin = settledOrigin + i*modelParameters.MODEL_WARM_START_CLEARANCE
+        if (modelParams.INCLUDE_END_CONSTRAINTS):
+            origin = max(origin, i*modelParams.BANDO_DESIRED_SPACING+STARTING_DISTANCE_FROM_END_CONSTRAINT)
+
+        origins.append(origin)
+
+    return origins
+
+
+# Modules kept for re-use by getModule(), keyed by their model parameters (oldest first)
+moduleTemplates:Dict[modelParameters.ModelParams, Module] = {}
+atexit.register(moduleTemplates.clear) # pymunk objects must be freed before pymunk itself is torn down at exit
+
+# Module with newly drawn tolerances for a monte-carlo iteration. If MODEL_REUSE_MODULES is set, a module is only
+# built the first time a set of model parameters is seen in this process and is re-randomised in place after that,
+# so the returned module is only valid until the next call with the same parameters
+def getModule(modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS, tolerances:Optional[List[Tuple[np.ndarray, np.ndarray, np.ndarray]]] = None, rng:Optional[np.random.Generator] = None, bandoOrigins:Optional[List[float]] = None) -> Module:
+    if (not modelParameters.MODEL_REUSE_MODULES):
+        with profiling.timer("moduleBuild"):
+            return Module(modelParams=modelParams, tolerances=tolerances, rng=rng, bandoOrigins=bandoOrigins)
+
+    module = moduleTemplates.get(modelParams)
+    if (module is None):
+        while (len(moduleTemplates) >= max(1, modelParameters.MODEL_MODULE_CACHE_SIZE)):
+            moduleTemplates.pop(next(iter(moduleTemplates)))
+
+        with profiling.timer("moduleBuild"):
+            module = Module(modelParams=modelParams, tolerances=tolerances, rng=rng, bandoOrigins=bandoOrigins)
+        moduleTemplates[modelParams] = module
+    else:
+        with profiling.timer("moduleReset"):
+            module.reset(tolerances, rng, bandoOrigins)
+
+    return module
 
 
 if __name__ == "__main__":
@@ -0,0 +1,188 @@
+###############
+# convergence.py
+# TOM WRIGHT 2021
+###############
+
+"""
+Convergence detectors used by simulateModule to decide when a simulation is stable. Once per step a detector is
+given the x velocities of the watched bandolier (as a single numpy array) and reports whether the simulation can
+stop. Detectors that need more than the velocities (eg. the sleep detector) are also told which bodies to watch.
+Detectors only keep running statistics (eg. the number of consecutive steps below the velocity threshold), so memory
+use does not grow with the number of simulation steps. The full maximum velocity history is only kept when it is
+requested (eg. to plot it when displayFigure is set). A detector can also be given a DivergenceMonitor
+(MODEL_ABORT_ENABLED), which sets abortReason once the velocities of the simulation grow so much that it is clearly not
+going to converge. Simulations that never settle without their velocities growing are not aborted.
+"""
+
+import abc
+import collections
+from typing import Deque, List, Optional
+import numpy as np
+import pymunk
+
+import modelParameters
+
+
+# Watches the maximum velocities of a simulation for signs it will not converge. The velocities are averaged over
+# windows of windowSize steps, and the trend is the average of the last averageWindows window means. After minSteps
+# the simulation is "diverging" if the trend is rising, above minLevel and growthFactor times its lowest so far. This
+# only catches runs whose velocities grow, such as modules with too wide a BANDO_DESIRED_SPACING. Runs that never
+# settle but keep wandering at low velocities are not caught, and run until MODEL_MAX_STEPS
+class DivergenceMonitor:
+    def __init__(self, windowSize:int = modelParameters.MODEL_ABORT_WINDOW, averageWindows:int = modelParameters.MODEL_ABORT_AVERAGE_WINDOWS, minSteps:int = modelParameters.MODEL_ABORT_MIN_STEPS,
+                 growthFactor:float = modelParameters.MODEL_ABORT_GROWTH_FACTOR, minLevel:float = modelParameters.MODEL_ABORT_MIN_LEVEL) -> None:
+        self.windowSize:int = max(1, windowSize)
+        self.averageWindows:int = max(1, averageWindows)
+        self.minSteps:int = minSteps
+        self.growthFactor:float = growthFactor
+        self.minLevel:float = minLevel
+
+        self.reset()
+
+    def reset(self) -> None:
+        self.steps:int = 0
+        self.windowSum:float = 0
+        self.windowMeans:Deque[float] = collections.deque(maxlen=self.averageWindows)
+        self.trend:float = np.inf
+        self.lowestTrend:float = np.inf
+
+    # Add the maximum velocity of a step. Returns the reason to abort, or "" to carry on
+    def update(self, maxVelocity:float) -> str:
+        self.steps += 1
+        self.windowSum += maxVelocity
+        if (self.steps % self.windowSize != 0):
+            return ""
+
+        windowMean = self.windowSum/self.windowSize
+        self.windowSum = 0
+
+        self.windowMeans.append(windowMean)
+        if (len(self.windowMeans) < self.averageWindows):
+            return ""
+
+        previousTrend = self.trend
+        self.trend = sum(self.windowMeans)/self.averageWindows
+        self.lowestTrend = min(self.lowestTrend, self.trend)
+
+        if (self.steps < self.minSteps):
+            return ""
+        if (self.trend > previousTrend and self.trend > self.minLevel and self.trend > self.growthFactor*self.lowestTrend):
+            return "diverging"
+
+        return ""
+
+
+# Base class for all convergence detectors. Subclasses implement update()
+class ConvergenceDetector(abc.ABC):
+    def __init__(self, keepHistory:bool = False) -> None:
+        self.keepHistory:bool = keepHistory
+        self.bodies:List[pymunk.Body] = []
+        self.monitor:Optional[DivergenceMonitor] = None
+
+        self.reset()
+
+    def reset(self) -> None:
+        self.stable:bool = False
+        self.steps:int = 0
+        self.maxVelocity:float = 0 # maximum velocity of the latest step
+        self.history:Optional[List[float]] = [] if self.keepHistory else None
+        self.abortReason:str = "" # set by the monitor if the simulation should be aborted
+
+        if (self.monitor is not None):
+            self.monitor.reset()
+
+        # body sleeping statistics, only tracked by detectors that use sleeping
+        self.sleepingBodies:int = 0
+        self.firstSleepStep:int = -1
+        self.allAsleepStep:int = -1
+
+    # Set the dynamic bodies being simulated
+    def watch(self, bodies:List[pymunk.Body]) -> None:
+        self.bodies = bodies
+
+    # Returns True when the simulation has converged and can stop
+    @abc.abstractmethod
+    def update(self, velocities:np.ndarray) -> bool:
+        pass
+
+    # Store the maximum absolute velocity of this step (and the history if kept)
+    def record(self, velocities:np.ndarray) -> float:
+        maxVelocity = float(np.max(np.absolute(velocities)))
+        self.maxVelocity = maxVelocity
+        self.steps += 1
+
+        if (self.history is not None):
+            self.history.append(maxVelocity)
+
+        if (self.monitor is not None and not self.abortReason):
+            self.abortReason = self.monitor.update(maxVelocity)
+
+        return maxVelocity
+
+
+# Stable once the maximum velocity has been below minVelocity for thresholdCount consecutive steps
+class VelocityThresholdDetector(ConvergenceDetector):
+    def __init__(self, minVelocity:float = modelParameters.MODEL_MIN_VELOCITY, thresholdCount:int = modelParameters.MODEL_IN_VELOCITY_THRESHOLD_COUNT, keepHistory:bool = False) -> None:
+        self.minVelocity:float = minVelocity
+        self.thresholdCount:int = thresholdCount
+
+        super().__init__(keepHistory)
+
+    def reset(self) -> None:
+        super().reset()
+        self.countInThreshold:int = 0
+
+    def update(self, velocities:np.ndarray) -> bool:
+        maxVelocity = self.record(velocities)
+
+        if (maxVelocity < self.minVelocity):
+            self.countInThreshold += 1
+        else:
+            self.countInThreshold = 0
+
+        if (self.countInThreshold >= self.thresholdCount):
+            self.stable = True
+
+        return self.stable
+
+
+# Stable once every watched body has fallen asleep (requires sleeping to be enabled in the space, see setupSpace)
+class SleepDetector(ConvergenceDetector):
+    def __init__(self, checkInterval:int = modelParameters.MODEL_SLEEP_CHECK_INTERVAL, keepHistory:bool = False) -> None:
+        self.checkInterval:int = max(1, checkInterval)
+
+        super().__init__(keepHistory)
+
+    def update(self, velocities:np.ndarray) -> bool:
+        self.record(velocities)
+        step = self.steps-1
+
+        if (step % self.checkInterval == 0 and len(self.bodies) > 0):
+            self.sleepingBodies = sum(body.is_sleeping for body in self.bodies)
+
+            if (self.sleepingBodies > 0 and self.firstSleepStep < 0):
+                self.firstSleepStep = step
+
+            if (self.sleepingBodies == len(self.bodies)):
+                self.allAsleepStep = step
+                self.stable = True
+
+        return self.stable
+
+
+# Detector matching the model parameters
+def createDetector(modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS, keepHistory:bool = False) -> ConvergenceDetector:
+    if (modelParams.MODEL_SLEEP_ENABLED):
+        detector = SleepDetector(modelParams.MODEL_SLEEP_CHECK_INTERVAL, keepHistory)
+    else:
+        detector = VelocityThresholdDetector(keepHistory=keepHistory)
+
+    if (modelParams.MODEL_ABORT_ENABLED):
+        detector.monitor = DivergenceMonitor(modelParams.MODEL_ABORT_WINDOW, modelParams.MODEL_ABORT_AVERAGE_WINDOWS, modelParams.MODEL_ABORT_MIN_STEPS,
+                                             modelParams.MODEL_ABORT_GROWTH_FACTOR, modelParams.MODEL_ABORT_MIN_LEVEL)
+
+    return detector
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,251 @@
+###############
+# distributed.py
+# TOM WRIGHT 2021
+###############
+
+"""
+This file can be run independantly, as the coordinator or as a worker of a distributed sweep:
+    python distributed.py coordinator [--iterations N] [--resume] [--host ADDRESS]
+    python distributed.py worker [--host HOSTNAME]
+Runs a multiModel sweep over several machines. The coordinator expands the design points of varyModelInputs() into
+tasks (as runMultiModel does) and serves them over TCP with multiprocessing.managers. Workers, on any number of
+machines (or several on one machine), pull batches of tasks, simulate them on their local pool (see execution.py)
+and push the result rows back, which the coordinator writes to the results store. Workers send a heartbeat every
+DISTRIBUTED_HEARTBEAT_INTERVAL, and the tasks of a worker that has not been heard from for
+DISTRIBUTED_HEARTBEAT_TIMEOUT are re-queued for the other workers. A result of a re-queued task that arrives late is
+only written once. The coordinator port must be reachable from the workers, and every machine must use the same code
+and authentication key. The manager unpickles whatever an authenticated client sends, so anyone with the key can run
+code on the coordinator. There is no default key, it is read from the DISTRIBUTED_AUTHKEY_VARIABLE environment
+variable (or --authkey, which is visible to other users of the machine), and should be a long random secret kept
+private to the machines of the sweep. The coordinator listens on localhost unless --host is given (eg. "" for every
+interface).
+"""
+
+import argparse
+import collections
+import os
+import queue
+import socket
+import threading
+import time
+from multiprocessing.managers import BaseManager
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+
+from tqdm import tqdm
+
+import execution
+import modelParameters
+import multiModel
+import resultsWriter
+
+DISTRIBUTED_HOST = "localhost" # address of the coordinator, use "" on the coordinator to listen on every interface
+DISTRIBUTED_PORT = 50000
+DISTRIBUTED_AUTHKEY_VARIABLE = "BATTERY_MODEL_AUTHKEY" # environment variable holding the authentication key
+
+DISTRIBUTED_HEARTBEAT_INTERVAL = 5 # s between heartbeats of a worker
+DISTRIBUTED_HEARTBEAT_TIMEOUT = 30 # s without a heartbeat before a worker's tasks are re-queued
+DISTRIBUTED_BATCH_SIZE = None # tasks pulled by a worker at once, None uses twice the worker's processes
+DISTRIBUTED_IDLE_WAIT = 1 # s a worker waits before asking again when every task is leased to other workers
+
+Task = Tuple[Dict[str,Any], int, int, int] # multiModel.worker task
+
+
+# Task queue of the coordinator, called by the workers through the manager (from the manager's threads)
+class SweepCoordinator:
+    def __init__(self, tasks:Dict[str, Task]) -> None:
+        self.lock = threading.Lock()
+        self.pending:Deque[str] = collections.deque(tasks.keys())
+        self.tasks:Dict[str, Task] = tasks
+        self.leases:Dict[str, Set[str]] = {} # task keys leased to each worker
+        self.lastHeartbeat:Dict[str, float] = {}
+        self.completed:Set[str] = set()
+        self.results:queue.Queue = queue.Queue()
+        self.requeuedCount:int = 0
+
+    def heartbeat(self, workerId:str) -> None:
+        with self.lock:
+            self.lastHeartbeat[workerId] = time.monotonic()
+
+    # Up to batchSize (key, task) pairs for a worker, an empty list if every remaining task is leased to other
+    # workers (ask again later) or None once the sweep is finished
+    def getTasks(self, workerId:str, batchSize:int) -> Optional[List[Tuple[str, Task]]]:
+        with self.lock:
+            self.lastHeartbeat[workerId] = time.monotonic()
+            if (self.finished()):
+                return None
+
+            batch = []
+            while (len(self.pending) > 0 and len(batch) < batchSize):
+                key = self.pending.popleft()
+                if (key not in self.completed):
+                    batch.append((key, self.tasks[key]))
+
+            self.leases.setdefault(workerId, set()).update(key for key, _ in batch)
+
+            return batch
+
+    def putResults(self, workerId:str, results:List[Tuple[str, Dict[str,Any]]]) -> None:
+        with self.lock:
+            self.lastHeartbeat[workerId] = time.monotonic()
+            for key, row in results:
+                self.leases.get(workerId, set()).discard(key)
+                if (key not in self.completed):
+                    self.completed.add(key)
+                    self.results.put(row)
+
+    # Re-queue the leased tasks of workers that have not been heard from for DISTRIBUTED_HEARTBEAT_TIMEOUT
+    def requeueLostTasks(self) -> List[str]:
+        lostWorkers = []
+        with self.lock:
+            now = time.monotonic()
+            for workerId, lastHeartbeat in self.lastHeartbeat.items():
+                leased = [key for key in self.leases.get(workerId, ()) if key not in self.completed]
+                if (now-lastHeartbeat > DISTRIBUTED_HEARTBEAT_TIMEOUT and len(leased) > 0):
+                    self.pending.extendleft(leased)
+                    self.leases[workerId] = set()
+                    self.requeuedCount += len(leased)
+                    lostWorkers.append(workerId)
+
+        return lostWorkers
+
+    def finished(self) -> bool:
+        return len(self.completed) == len(self.tasks)
+
+
+class CoordinatorManager(BaseManager):
+    pass
+
+
+# Authentication key of the sweep, from the command line or else the environment. Raises if neither gives one
+def getAuthkey(authkey:Optional[str] = None) -> bytes:
+    if (authkey is None):
+        authkey = os.environ.get(DISTRIBUTED_AUTHKEY_VARIABLE)
+
+    if (not authkey):
+        raise ValueError(f"No authentication key, set the {DISTRIBUTED_AUTHKEY_VARIABLE} environment variable (or pass --authkey)")
+
+    return authkey.encode() if isinstance(authkey, str) else authkey
+
+
+# Serve the tasks of a sweep (as in multiModel.runMultiModel) to workers until every task has a result, writing the
+# results to the results store
+def runCoordinator(numIterations:int, authkey:bytes, engine:str=None, resume:bool=False, seed:int=None, host:str=DISTRIBUTED_HOST, port:int=DISTRIBUTED_PORT):
+    # the manager would run code sent by anyone who can reach it without a key
+    if (not authkey):
+        raise ValueError(f"Refusing to listen on {host or 'every interface'}:{port} without an authentication key")
+
+    inputList, completed, rootSeed = multiModel.setupSweep(engine, resume, seed)
+
+    completedKeys = set(completed.get("taskKey", []))
+    tasks = {}
+    for modelInput in inputList:
+        for iteration in range(numIterations):
+            key = multiModel.taskKey(modelInput, iteration, rootSeed, numIterations)
+            if (key not in completedKeys):
+                tasks[key] = (modelInput, iteration, rootSeed, numIterations)
+
+    if (resume):
+        print(f"Resuming, {len(inputList)*numIterations-len(tasks)} of {len(inputList)*numIterations} iterations already complete")
+
+    coordinator = SweepCoordinator(tasks)
+    CoordinatorManager.register("coordinator", callable=lambda: coordinator)
+    server = CoordinatorManager(address=(host, port), authkey=authkey).get_server()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Coordinator listening on {host or socket.gethostname()}:{port} with {len(tasks)} tasks")
+
+    numStable = 0
+    with resultsWriter.ResultsWriter(append=resume) as writer, tqdm(total=len(tasks), unit="Iteration", desc="Distributed") as progressBar:
+        while (progressBar.n < len(tasks)):
+            try:
+                row = coordinator.results.get(timeout=DISTRIBUTED_HEARTBEAT_INTERVAL)
+            except queue.Empty:
+                row = None
+
+            if (row is not None):
+                writer.write(row)
+                numStable += row["stable"]
+                progressBar.update(1)
+
+            for workerId in coordinator.requeueLostTasks():
+                progressBar.write(f"Lost worker {workerId}, re-queued its tasks")
+
+    # give the workers a chance to find out the sweep has finished before the server stops
+    time.sleep(DISTRIBUTED_IDLE_WAIT + 1)
+
+    print(f"Number of stable iterations: {numStable}")
+    print(f"Re-queued tasks: {coordinator.requeuedCount}")
+
+    if (multiModel.EXPORT_CSV):
+        resultsWriter.exportCSV(csvFileName=multiModel.RESULTS_FILE_NAME)
+
+
+# Pull batches of tasks from the coordinator and simulate them on the local pool until the sweep is finished. A
+# heartbeat is sent from a separate thread, so long simulations do not get a worker's tasks re-queued
+def runWorker(authkey:bytes, host:str=DISTRIBUTED_HOST, port:int=DISTRIBUTED_PORT, batchSize:int=DISTRIBUTED_BATCH_SIZE):
+    workerId = f"{socket.gethostname()}:{os.getpid()}"
+    if (batchSize is None):
+        batchSize = 2*(modelParameters.POOL_PROCESSES or os.cpu_count() or 1)
+
+    CoordinatorManager.register("coordinator")
+    manager = CoordinatorManager(address=(host, port), authkey=authkey)
+    manager.connect()
+    coordinator = manager.coordinator()
+
+    stopHeartbeat = threading.Event()
+    def sendHeartbeats():
+        while (not stopHeartbeat.wait(DISTRIBUTED_HEARTBEAT_INTERVAL)):
+            try:
+                coordinator.heartbeat(workerId)
+            except (OSError, EOFError):
+                return
+
+    threading.Thread(target=sendHeartbeats, daemon=True).start()
+    print(f"Worker {workerId} connected to {host}:{port}")
+
+    pool = execution.getPool()
+    numTasks = 0
+    try:
+        while (True):
+            try:
+                batch = coordinator.getTasks(workerId, batchSize)
+            except (OSError, EOFError):
+                print("Lost the coordinator")
+                break
+
+            if (batch is None):
+                break
+            if (len(batch) == 0):
+                time.sleep(DISTRIBUTED_IDLE_WAIT)
+                continue
+
+            keys = [key for key, _ in batch]
+            rows = pool.map(multiModel.worker, [task for _, task in batch], execution.chunkSize(len(batch)))
+            coordinator.putResults(workerId, list(zip(keys, rows)))
+            numTasks += len(batch)
+    finally:
+        stopHeartbeat.set()
+
+    print(f"Worker {workerId} finished after {numTasks} tasks")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distributed multiModel sweep")
+    parser.add_argument("role", choices=["coordinator", "worker"])
+    parser.add_argument("--host", default=DISTRIBUTED_HOST)
+    parser.add_argument("--port", type=int, default=DISTRIBUTED_PORT)
+    parser.add_argument("--iterations", type=int, default=modelParameters.MODEL_NUM_ITERATIONS)
+    parser.add_argument("--engine", default=None)
+    parser.add_argument("--resume", action="store_true")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--authkey", default=None, help=f"authentication key, defaults to the {DISTRIBUTED_AUTHKEY_VARIABLE} environment variable")
+    args = parser.parse_args()
+
+    try:
+        authkey = getAuthkey(args.authkey)
+    except ValueError as error:
+        parser.error(str(error))
+
+    if (args.role == "coordinator"):
+        runCoordinator(args.iterations, authkey, args.engine, args.resume, args.seed, args.host, args.port)
+    else:
+        runWorker(authkey, args.host, args.port)
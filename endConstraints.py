@@ -58,13 +58,26 @@ class EndConstraint:
 
         self.shape.filter = pymunk.ShapeFilter(categories=2, mask=2)
 
+        self.createJoints()
+
+    # Pin the constraint to the adjacent cells at their current positions
+    def createJoints(self) -> None:
+        self.joints:List[pymunk.Constraint] = []
         for cellBody in self.adjacentCellBodies:
             joint1 = pymunk.PinJoint(cellBody,self.body)
             joint2 = pymunk.PinJoint(cellBody,self.body,anchor_b=(self.xThickness,(self.yNominalOuter-self.yNominalInner)))
             self.space.add(joint1, joint2)
+            self.joints.extend([joint1, joint2])
             
     def setFilter(self, category:int, mask:int) -> None:
         self.shape.filter = pymunk.ShapeFilter(categories=category, mask=mask)
+
+    # Put the constraint back at its start position at rest
+    def reset(self) -> None:
+        self.body.position = (self.xStart+self.xNominal, self.yStart+self.yNominalOuter)
+        self.body.velocity = (0, 0)
+        self.body.angle = 0
+        self.body.angular_velocity = 0
    
 
 @dataclass
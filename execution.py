@@ -0,0 +1,89 @@
+###############
+# execution.py
+# TOM WRIGHT 2021
+###############
+
+"""
+Worker pool shared by every multiprocessing entry point (model.py, multiModel.py, geometricSolver.py). The pool is
+created once and re-used by every call until shutdownPool() (or the end of the program), rather than a new pool per
+call. Each worker process is initialised once: the settings of modelParameters.py are copied from the parent (so
+settings changed at run time, eg. ANALYTICS_LEVEL or MODEL_MAX_STEPS, reach the workers), the simulation modules are
+imported and the modules for the design points that are about to be simulated are built (see components.getModule),
+so the first tasks do not pay for them. The pool is created again when the settings or the warm design points
+change, as replaced workers are initialised the same way. Workers are replaced every POOL_MAX_TASKS_PER_CHILD tasks
+to limit memory creep, and tasks are sent to workers in chunks (POOL_CHUNKSIZE, or sized to the number of tasks) to
+cut the dispatch overhead of short tasks.
+"""
+
+import atexit
+import os
+from multiprocessing.pool import Pool
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+import modelParameters
+
+pool:Optional[Pool] = None
+poolSettings:Dict[str, Any] = {}
+poolWarmParams:Tuple[modelParameters.ModelParams, ...] = ()
+
+
+# Current values of the settings in modelParameters.py
+def runSettings() -> Dict[str, Any]:
+    return {name:value for name, value in vars(modelParameters).items() if name.isupper()}
+
+# Worker initialiser, applies the settings of the parent, imports the simulation and builds the modules of warmParams
+# ahead of the first task
+def initialiseWorker(warmParams:Tuple[modelParameters.ModelParams, ...], settings:Dict[str, Any]) -> None:
+    for name, value in settings.items():
+        setattr(modelParameters, name, value)
+
+    import components
+    import geometricSolver
+    import simulation
+
+    if (not modelParameters.MODEL_REUSE_MODULES):
+        return
+
+    for modelParams in warmParams[:modelParameters.MODEL_MODULE_CACHE_SIZE]:
+        if (modelParams.SIMULATION_ENGINE != modelParameters.ENGINE_GEOMETRIC):
+            components.getModule(modelParams)
+
+# The shared pool, created on first use. warmParams are the model parameters the first tasks will use. The pool is
+# created again if a setting has changed since it was created, or if warmParams are given and differ from its own
+def getPool(warmParams:Iterable[modelParameters.ModelParams] = ()) -> Pool:
+    global pool, poolSettings, poolWarmParams
+
+    warmParams = tuple(warmParams)
+    settings = runSettings()
+    if (pool is not None and (settings != poolSettings or (len(warmParams) > 0 and warmParams != poolWarmParams))):
+        shutdownPool()
+
+    if (pool is None):
+        pool = Pool(modelParameters.POOL_PROCESSES, initialiseWorker, (warmParams, settings), modelParameters.POOL_MAX_TASKS_PER_CHILD)
+        poolSettings, poolWarmParams = settings, warmParams
+
+    return pool
+
+def shutdownPool() -> None:
+    global pool
+
+    if (pool is not None):
+        pool.close()
+        pool.join()
+        pool = None
+
+atexit.register(shutdownPool)
+
+# Number of tasks sent to a worker at once. Enough chunks are made to keep every worker busy until the end
+def chunkSize(numTasks:int) -> int:
+    if (modelParameters.POOL_CHUNKSIZE is not None):
+        return modelParameters.POOL_CHUNKSIZE
+
+    chunksPerProcess = 8
+    processes = modelParameters.POOL_PROCESSES or os.cpu_count() or 1
+
+    return max(1, min(modelParameters.POOL_MAX_CHUNKSIZE, numTasks//(chunksPerProcess*processes)))
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,295 @@
+###############
+# geometricSolver.py
+# TOM WRIGHT 2021
+###############
+
+"""
+This file can be run independantly (runs a validation against the physics simulation).
+Physics free solver for the resting position of a module. Each bandolier is treated as rigid, and is moved
+(against the stacking direction) until its cells rest on the cells of the previous bandolier or its end constraints
+reach their end limits. The bandolier may also slide in y and tilt slightly, and settles in the pose with the lowest
+x position (potential energy). Every pair of cells of neighbouring bandoliers that could touch is checked at once,
+vectorised with numpy over the candidate poses (and optionally over many modules at once). The solver uses the same
+tolerance sampling as Module and returns the same analytics as simulationAnalytics, so it can be used as a much
+faster engine for monte-carlo runs. Since bandoliers cannot bend or rotate, results should be checked against the
+physics simulation with validateAgainstPhysics().
+"""
+
+from dataclasses import replace
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from tqdm import tqdm
+
+import analytics as moduleAnalytics
+import components
+import execution
+import modelParameters
+import profiling
+import seeding
+from endConstraints import EndLimit
+
+# Search range of the y shift (mm) and tilt (rad) of each bandolier, and the grid used to search them
+GEOMETRIC_Y_RANGE = 1
+GEOMETRIC_TILT_RANGE = 0.003
+GEOMETRIC_GRID_SIZE = 9
+GEOMETRIC_REFINEMENTS = 6
+
+# The physics simulation lets resting contacts overlap by the space's collision slop, so the solver does the same
+CONTACT_ALLOWANCE = components.setupSpace().collision_slop
+
+# Sample the tolerances of every bandolier in a module, in the same order of random draws as Module
+def sampleModuleTolerances(modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS, rng:Optional[np.random.Generator] = None) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    if (rng is None):
+        rng = seeding.generator()
+
+    return [components.sampleCellTolerances(modelParams, rng) for _ in range(modelParams.MODULE_BANDO_COUNT)]
+
+# Stack module tolerances (as sampled above) into x offset, y offset and diameter arrays of shape (bandoliers, cells)
+def stackTolerances(tolerances:List[Tuple[np.ndarray, np.ndarray, np.ndarray]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    xOffsets, yOffsets, diameters = zip(*tolerances)
+
+    return (np.stack(xOffsets), np.stack(yOffsets), np.stack(diameters))
+
+# Points on the end constraints that can touch the end limits. Returns their local y positions and the x offset of
+# the end limit from the desired bandolier position minus the x offset of the end constraint
+def endLimitContacts(modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS) -> Tuple[np.ndarray, np.ndarray]:
+    if (not modelParams.INCLUDE_END_CONSTRAINTS):
+        return (np.zeros(0), np.zeros(0))
+
+    _, yNominal = components.nominalCellPositions(modelParams)
+    yBottom, yTop = yNominal[0], yNominal[-1]
+
+    # the end constraints can only reach the end limits where their heights overlap
+    overlaps = [(max(yBottom-modelParams.END_CONSTRAINT_LOWER_Y, -modelParams.END_LIMIT_LOWER_Y), min(yBottom, -modelParams.END_LIMIT_LOWER_Y+EndLimit.height), modelParams.END_LIMIT_LOWER_X-modelParams.END_CONSTRAINT_LOWER_X),
+                (max(yTop, yTop+modelParams.END_LIMIT_UPPER_Y-EndLimit.height), min(yTop+modelParams.END_CONSTRAINT_UPPER_Y, yTop+modelParams.END_LIMIT_UPPER_Y), modelParams.END_LIMIT_UPPER_X-modelParams.END_CONSTRAINT_UPPER_X)]
+
+    contactYs = []
+    contactOffsets = []
+    for yLow, yHigh, xOffset in overlaps:
+        if (yHigh > yLow):
+            contactYs.extend([yLow, yHigh])
+            contactOffsets.extend([xOffset, xOffset])
+
+    return (np.array(contactYs), np.array(contactOffsets))
+
+# Local positions of the end constraint bodies of a bandolier (as placed in Bandolier.setupEndConstraints)
+def endConstraintPositions(modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS) -> np.ndarray:
+    _, yNominal = components.nominalCellPositions(modelParams)
+
+    return np.array([[modelParams.END_CONSTRAINT_LOWER_X, yNominal[0]-modelParams.END_CONSTRAINT_LOWER_Y],
+                    [modelParams.END_CONSTRAINT_UPPER_X, yNominal[-1]+modelParams.END_CONSTRAINT_UPPER_Y]])
+
+# Resting pose of every bandolier. Arrays have shape (..., bandoliers, cells), any leading dimensions are separate
+# modules solved at once. Each bandolier may move in x and y and rotate (small angles) about its centre of mass.
+# For every candidate y shift and tilt on a grid, the smallest x origin that keeps every pair of cells (and the end
+# constraints) from overlapping is found, and the grid is refined around the pose with the smallest x origin (lowest
+# potential energy). The first bandolier is static at its origin (as in Module).
+# Returns the x origins, y shifts, tilts and the (x, y) centre of mass of each bandolier in local coordinates
+def solveBandoPoses(xOffsets:np.ndarray, yOffsets:np.ndarray, diameters:np.ndarray, modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    xNominal, yNominal = components.nominalCellPositions(modelParams)
+    localX = xNominal + xOffsets
+    localY = yNominal + yOffsets
+    radii = diameters/2
+
+    # centre of mass of the cells and end constraints (all bodies have the same mass)
+    centreX, centreY = localX.sum(axis=-1), localY.sum(axis=-1)
+    bodyCount = localX.shape[-1]
+    if (modelParams.INCLUDE_END_CONSTRAINTS):
+        constraintPositions = endConstraintPositions(modelParams)
+        centreX, centreY = centreX+constraintPositions[:, 0].sum(), centreY+constraintPositions[:, 1].sum()
+        bodyCount += len(constraintPositions)
+    centres = np.stack([centreX, centreY], axis=-1)/bodyCount
+
+    # cells are ordered by height, so only cells with nearby indices can touch
+    cellCount = localX.shape[-1]
+    minYPitch = min(modelParams.BANDO_CELL_Y1, modelParams.BANDO_CELL_Y2-modelParams.BANDO_CELL_Y1)
+    reachY = diameters.max() + 2*np.absolute(yOffsets).max() + GEOMETRIC_Y_RANGE
+    window = min(cellCount-1, int(np.ceil(reachY/max(minYPitch, 1e-9))))
+    cellPairs = [(np.arange(max(0, -offset), min(cellCount, cellCount-offset)), offset) for offset in range(-window, window+1)]
+    cellIds = np.concatenate([ids for ids, _ in cellPairs])
+    neighbourIds = np.concatenate([ids+offset for ids, offset in cellPairs])
+
+    contactYs, contactOffsets = endLimitContacts(modelParams)
+
+    leadingShape = localX.shape[:-2]
+    origins = np.zeros(localX.shape[:-1])
+    yShifts = np.zeros(localX.shape[:-1])
+    tilts = np.zeros(localX.shape[:-1])
+    previousX, previousY = localX[..., 0, :], localY[..., 0, :]
+
+    for k in range(1, origins.shape[-1]):
+        # only keep pairs of cells that are close enough in y to touch for some pose in the search range
+        reach = radii[..., k, cellIds] + radii[..., k-1, neighbourIds] - CONTACT_ALLOWANCE
+        closePairs = np.absolute(localY[..., k, cellIds]-previousY[..., neighbourIds]) < reach + 2*GEOMETRIC_Y_RANGE
+        closePairs = closePairs.reshape(-1, len(cellIds)).any(axis=0)
+        pairCellIds, pairNeighbourIds = cellIds[closePairs], neighbourIds[closePairs]
+
+        cellX, cellY = localX[..., k, pairCellIds], localY[..., k, pairCellIds]
+        neighbourX, neighbourY = previousX[..., pairNeighbourIds], previousY[..., pairNeighbourIds]
+        reach = reach[..., closePairs]
+        centre = centres[..., k, :]
+        desiredX = k*modelParams.BANDO_DESIRED_SPACING
+
+        # smallest x origin for poses of shape (..., candidates)
+        def requiredOrigin(yShift:np.ndarray, tilt:np.ndarray) -> np.ndarray:
+            expand = (Ellipsis,) + (None,)*(yShift.ndim-len(leadingShape)) + (slice(None),)
+            yShift, tilt = yShift[..., None], tilt[..., None]
+
+            rotatedX = cellX[expand] - tilt*(cellY[expand]-centre[expand][..., 1:2])
+            rotatedY = yShift + cellY[expand] + tilt*(cellX[expand]-centre[expand][..., 0:1])
+            overlapSquared = reach[expand]**2 - (rotatedY - neighbourY[expand])**2
+            touching = overlapSquared > 0
+
+            dx = np.sqrt(np.maximum(overlapSquared, 0)) + neighbourX[expand] - rotatedX
+            origin = np.where(touching, dx, -np.inf).max(axis=-1)
+
+            if (len(contactYs) > 0):
+                limitOrigin = desiredX + contactOffsets + tilt*(contactYs - centre[expand][..., 1:2])
+                origin = np.maximum(origin, limitOrigin.max(axis=-1))
+
+            return origin
+
+        bestY, bestTilt = np.zeros(leadingShape), np.zeros(leadingShape)
+        yRange, tiltRange = GEOMETRIC_Y_RANGE, GEOMETRIC_TILT_RANGE
+        grid = np.linspace(-1, 1, GEOMETRIC_GRID_SIZE)
+        for _ in range(GEOMETRIC_REFINEMENTS):
+            yCandidates = (bestY[..., None, None] + yRange*grid[:, None]) + 0*grid
+            tiltCandidates = (bestTilt[..., None, None] + tiltRange*grid) + 0*grid[:, None]
+            candidateOrigins = requiredOrigin(yCandidates, tiltCandidates).reshape(leadingShape + (-1,))
+
+            best = np.argmin(candidateOrigins, axis=-1)[..., None]
+            bestY = np.take_along_axis(yCandidates.reshape(leadingShape + (-1,)), best, axis=-1)[..., 0]
+            bestTilt = np.take_along_axis(tiltCandidates.reshape(leadingShape + (-1,)), best, axis=-1)[..., 0]
+
+            yRange, tiltRange = 4*yRange/GEOMETRIC_GRID_SIZE, 4*tiltRange/GEOMETRIC_GRID_SIZE
+
+        origins[..., k] = requiredOrigin(bestY[..., None], bestTilt[..., None])[..., 0]
+        yShifts[..., k] = bestY
+        tilts[..., k] = bestTilt
+
+        previousX, previousY = posedPositions(localX[..., k, :], localY[..., k, :], origins[..., k], yShifts[..., k], tilts[..., k], centres[..., k, :])
+
+    return (origins, yShifts, tilts, centres)
+
+# Positions of points given in local bandolier coordinates once the bandolier is moved to its pose
+def posedPositions(localX:np.ndarray, localY:np.ndarray, origin:np.ndarray, yShift:np.ndarray, tilt:np.ndarray, centre:np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    origin, yShift, tilt = origin[..., None], yShift[..., None], tilt[..., None]
+
+    x = origin + localX - tilt*(localY-centre[..., 1:2])
+    y = yShift + localY + tilt*(localX-centre[..., 0:1])
+
+    return (x, y)
+
+# Analytics of a solved module, in the same format (and at the same level) as simulationAnalytics
+def geometricAnalytics(xOffsets:np.ndarray, yOffsets:np.ndarray, diameters:np.ndarray, poses:Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray], modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS, level:str = None) -> Dict[str, Any]:
+    xNominal, yNominal = components.nominalCellPositions(modelParams)
+    origins, yShifts, tilts, centres = poses
+    finalX, finalY = posedPositions(xNominal + xOffsets, yNominal + yOffsets, origins, yShifts, tilts, centres)
+
+    analytics = {
+                    "stable":True,
+                    "totalModuleWidth":components.moduleWidth(finalX, diameters),
+                    "simulationSteps":0,
+                    "simulatedTime":0,
+                    "sleepingBodies":0,
+                    "firstSleepStep":-1,
+                    "allAsleepStep":-1,
+                    "abortReason":"",
+                    "bandoliers":[]
+                }
+
+    if (modelParams.INCLUDE_END_CONSTRAINTS):
+        constraintPositions = endConstraintPositions(modelParams)
+        constraintX, constraintY = posedPositions(constraintPositions[:, 0], constraintPositions[:, 1], origins, yShifts, tilts, centres)
+
+    for i in range(len(origins)):
+        if (modelParams.INCLUDE_END_CONSTRAINTS):
+            desiredX = i*modelParams.BANDO_DESIRED_SPACING
+            lowerDistance = (constraintX[i, 0]-desiredX-modelParams.END_LIMIT_LOWER_X, constraintY[i, 0]-(yNominal[0]-modelParams.END_LIMIT_LOWER_Y))
+            upperDistance = (constraintX[i, 1]-desiredX-modelParams.END_LIMIT_UPPER_X, constraintY[i, 1]-(yNominal[-1]+modelParams.END_LIMIT_UPPER_Y))
+        else:
+            upperDistance = (0,0)
+            lowerDistance = (0,0)
+
+        analytics["bandoliers"].append({
+                                            "upperDistanceX":upperDistance[0],
+                                            "upperDistanceY":upperDistance[1],
+                                            "lowerDistanceX":lowerDistance[0],
+                                            "lowerDistanceY":lowerDistance[1]
+                                        })
+
+    return moduleAnalytics.addDetailedAnalytics(analytics, np.stack((finalX, finalY), axis=-1), diameters, modelParams, level)
+
+# Sample and solve a single module
+def solveModule(modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS, tolerances:List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None, rng:Optional[np.random.Generator] = None) -> Dict[str, Any]:
+    if (tolerances is None):
+        tolerances = sampleModuleTolerances(modelParams, rng)
+
+    with profiling.timer("geometricSolve"):
+        xOffsets, yOffsets, diameters = stackTolerances(tolerances)
+        poses = solveBandoPoses(xOffsets, yOffsets, diameters, modelParams)
+
+    with profiling.timer("analytics"):
+        return geometricAnalytics(xOffsets, yOffsets, diameters, poses, modelParams)
+
+# Sample and solve numIterations modules, solving batchSize modules at a time
+def simulateGeometric(numIterations:int, modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS, batchSize:int = 1, includeProgressBar:bool = True, rng:Optional[np.random.Generator] = None) -> List[Dict[str, Any]]:
+    results:List[Dict[str, Any]] = []
+    if (rng is None):
+        rng = seeding.generator()
+
+    with tqdm(total=numIterations, unit="Iteration", desc="Geometric", disable=(not includeProgressBar)) as progressBar:
+        while (len(results) < numIterations):
+            batch = [stackTolerances(sampleModuleTolerances(modelParams, rng)) for _ in range(min(batchSize, numIterations-len(results)))]
+            xOffsets, yOffsets, diameters = (np.stack(x) for x in zip(*batch))
+
+            poses = solveBandoPoses(xOffsets, yOffsets, diameters, modelParams)
+
+            for i in range(len(batch)):
+                results.append(geometricAnalytics(xOffsets[i], yOffsets[i], diameters[i], tuple(x[i] for x in poses), modelParams))
+
+            progressBar.update(len(batch))
+
+    return results
+
+def validationWorker(task:Tuple[modelParameters.ModelParams, int]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    from simulation import simulateModule, simulationAnalytics
+
+    modelParams, seed = task
+    physicsParams = modelParams
+    if (modelParams.SIMULATION_ENGINE == modelParameters.ENGINE_GEOMETRIC):
+        physicsParams = replace(modelParams, SIMULATION_ENGINE=modelParameters.ENGINE_PHYSICS)
+
+    tolerances = sampleModuleTolerances(modelParams, seeding.generator(seed))
+
+    module = components.getModule(physicsParams, tolerances)
+    stable = simulateModule(module, includeProgressBar=False)
+
+    return (solveModule(modelParams, tolerances), simulationAnalytics(module, stable))
+
+# Compare the geometric solver against the physics simulation on the same sampled modules. Returns the
+# (geometric, physics) analytics of each sample
+def validateAgainstPhysics(numSamples:int, modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS, printSummary:bool = True, firstSeed:int = 0) -> List[Tuple[Dict[str, Any], Dict[str, Any]]]:
+    pool = execution.getPool([replace(modelParams, SIMULATION_ENGINE=modelParameters.ENGINE_PHYSICS)])
+
+    results = list(tqdm(pool.imap_unordered(validationWorker, ((modelParams, firstSeed+i) for i in range(numSamples)), execution.chunkSize(numSamples)),
+                        total=numSamples,
+                        unit="Sample",
+                        desc="Validation"))
+
+    if (printSummary):
+        stableResults = [x for x in results if x[1]["stable"]]
+        widthErrors = np.array([geometric["totalModuleWidth"]-physics["totalModuleWidth"] for geometric, physics in stableResults])
+        limitErrors = np.array([[g["lowerDistanceX"]-p["lowerDistanceX"] for g, p in zip(geometric["bandoliers"], physics["bandoliers"])] for geometric, physics in stableResults])
+
+        print(f"Stable physics samples: {len(stableResults)}/{numSamples}")
+        if (len(stableResults) > 0):
+            print(f"Total width error (geometric - physics): mean {widthErrors.mean():.3f}mm, std {widthErrors.std():.3f}mm, max abs {np.absolute(widthErrors).max():.3f}mm")
+            print(f"Lower limit x distance error: mean {limitErrors.mean():.3f}mm, max abs {np.absolute(limitErrors).max():.3f}mm")
+
+    return results
+
+
+if __name__ == "__main__":
+    validateAgainstPhysics(8)
@@ -11,61 +11,144 @@ can be included or ignored as set in modelParameters.py. This program uses multi
 your computer and fill up RAM while it is running. I recommend closing most other apps before use.
 """
 
-from multiprocessing import Pool
+from dataclasses import replace
+from functools import partial
 from tqdm import tqdm
 
-from typing import Any, Dict, Tuple, List
+from typing import Any, List
 
-from simulation import simulateModule, simulationAnalytics
-from components import Module
+from simulation import SimulationRecord, simulateModule, simulationRecord
+from components import getModule
+import execution
+import geometricSolver
 import modelParameters
-import matplotlib.pyplot as plt
-
-def worker(iteration) -> Tuple[Module, Dict[str, Any]]:
-    newModule = Module()
-    stable = simulateModule(newModule,includeProgressBar=False)
+import profiling
+import sampling
+import seeding
+import stopping
+import trajectory
+
+# Simulate a single monte-carlo iteration of a run, returning a compact record of the result (the module itself is
+# re-used by the next iteration). The tolerances depend on the sampling strategy, root seed, iteration and number
+# of iterations of the run, so calling the worker again with these re-simulates the iteration exactly. Trajectories
+# are recorded to the run's directory (see trajectory.runDirectory)
+def worker(iteration, modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS, rootSeed:int = 0, numIterations:int = 1) -> SimulationRecord:
+    tolerances = sampling.iterationTolerances(modelParams, rootSeed, iteration, numIterations)
+
+    return simulateTolerances(tolerances, modelParams, seeding.iterationSeed(rootSeed, iteration), trajectory.runDirectory(rootSeed))
+
+# Simulate the module randomly sampled from an iteration seed. Any result of a run with random sampling can be
+# re-simulated exactly from its recorded seed
+def simulateSeed(seed:int, modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS) -> SimulationRecord:
+    return simulateTolerances(sampling.seedTolerances(modelParams, seed), modelParams, seed)
+
+def simulateTolerances(tolerances, modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS, seed:int = None, trajectoryDirectory:str = modelParameters.TRAJECTORY_DIRECTORY) -> SimulationRecord:
+    # the geometric engine does not build a physics module
+    if (modelParams.SIMULATION_ENGINE == modelParameters.ENGINE_GEOMETRIC):
+        return SimulationRecord(geometricSolver.solveModule(modelParams, tolerances), modelParams, seed=seed)
+
+    newModule = getModule(modelParams, tolerances)
+    recorder = trajectory.seedRecorder(newModule, seed, trajectoryDirectory) if modelParameters.TRAJECTORY_RECORDING and seed is not None else None
+    stable = simulateModule(newModule,includeProgressBar=False, recorder=recorder)
 
     # print("Stable result\r" if stable else "Unstable result")
 
-    return (newModule, simulationAnalytics(newModule, stable))
+    record = simulationRecord(newModule, stable, seed)
+    if (recorder is not None):
+        record.trajectoryFile = recorder.close(newModule, record.analytics, seed)
+
+    return record
+
+
+def showHistogram(results:List[SimulationRecord]) -> None:
+    import visualisation
+    visualisation.showHistogram([x.totalModuleWidth for x in results])
 
 
-def showHistogram(results:List[Tuple[Module, Dict[str, Any]]]) -> None:
-    widths = [x[1]["totalModuleWidth"] for x in results]
+def runParameters(engine:str=None, samplingStrategy:str=None) -> modelParameters.ModelParams:
+    modelParams = modelParameters.DEFAULT_PARAMETERS
+    if (engine is not None):
+        modelParams = replace(modelParams, SIMULATION_ENGINE=engine)
+    if (samplingStrategy is not None):
+        modelParams = replace(modelParams, SAMPLING_STRATEGY=samplingStrategy)
 
-    # q25, q75 = np.percentile(widths, [25, 75])
-    # bin_width = 2 * (q75 - q25) * len(widths) ** (-1/3)
-    # bins = round((max(widths) - min(widths)) / bin_width)
+    return modelParams
 
-    fig = plt.figure()
-    # plt.hist(widths, density=True, bins=bins)  # density=False would make counts    
+# Start a run of a root seed. Trajectories left in its directory by an earlier run with the same root seed are removed
+def startRun(seed:int=None) -> int:
+    rootSeed = seeding.rootSeed(seed)
+    print(f"Root seed: {rootSeed}")
 
-    plt.hist(widths, density=True)
-    plt.ylabel('Probability')
-    plt.xlabel('Data')
+    if (modelParameters.TRAJECTORY_RECORDING):
+        trajectory.clearTrajectories(trajectory.runDirectory(rootSeed))
 
+    return rootSeed
 
-def runSimulation(numIterations:int, displayResults:bool=True) -> List[Tuple[Module, float, bool]]:    
-    pool = Pool()
+# seed is the root seed of the run (see seeding.py) and samplingStrategy overrides the SAMPLING_STRATEGY (see sampling.py)
+def runSimulation(numIterations:int, displayResults:bool=True, engine:str=None, seed:int=None, samplingStrategy:str=None) -> List[SimulationRecord]:    
+    profiling.reset()
+    modelParams = runParameters(engine, samplingStrategy)
+    pool = execution.getPool([modelParams])
 
-    results:List[Tuple[Module, Dict[str,Any]]] = list(tqdm(pool.imap_unordered(worker, 
-                                                                            range(numIterations)),
+    rootSeed = startRun(seed)
+
+    results:List[SimulationRecord] = [profiling.mergeResult(output) for output in tqdm(pool.imap_unordered(profiling.profiledWorker(partial(worker, modelParams=modelParams, rootSeed=rootSeed, numIterations=numIterations)), 
+                                                                            range(numIterations), execution.chunkSize(numIterations)),
                                                         total=numIterations,
                                                         unit="Iteration", 
-                                                        desc="Model"))
+                                                        desc="Model")]
+    profiling.writeProfile()
+
+    return summariseResults(results, displayResults)
+
+# Run iterations until the statistic of the module width has converged to within +/- tolerance (see stopping.py),
+# instead of a fixed number of iterations. The LHS sampling strategy is laid out over the maximum number of iterations
+def runUntilConverged(statistic:str=modelParameters.MODEL_STOPPING_STATISTIC, tolerance:float=modelParameters.MODEL_STOPPING_TOLERANCE, confidence:float=modelParameters.MODEL_STOPPING_CONFIDENCE, displayResults:bool=True, engine:str=None, seed:int=None, samplingStrategy:str=None) -> List[SimulationRecord]:
+    profiling.reset()
+    modelParams = runParameters(engine, samplingStrategy)
+    pool = execution.getPool([modelParams])
+    rule = stopping.StoppingRule(statistic, tolerance, confidence)
+
+    rootSeed = startRun(seed)
 
+    results:List[SimulationRecord] = []
+    def onResult(_, output:Any) -> float:
+        record = profiling.mergeResult(output)
+        results.append(record)
+        if (modelParameters.DISCARD_UNSTABLE_RESULTS and not record.analytics["stable"]):
+            return None
+
+        return record.totalModuleWidth
+
+    with tqdm(unit="Iteration", desc="Model") as progressBar:
+        stopping.runSequentially(pool, profiling.profiledWorker(partial(worker, modelParams=modelParams, rootSeed=rootSeed, numIterations=rule.maxIterations)),
+                                 lambda _, iteration: iteration, [rule], onResult, progressBar=progressBar)
+    profiling.writeProfile()
+
+    print(f"{'Converged' if rule.converged() else 'Not converged'}: {rule.summary()}")
+
+    return summariseResults(results, displayResults)
+
+def summariseResults(results:List[SimulationRecord], displayResults:bool=True) -> List[SimulationRecord]:
     if (modelParameters.DISCARD_UNSTABLE_RESULTS):
-        results = list(filter(lambda x: (x[1]["stable"]), results))
+        results = list(filter(lambda x: (x.analytics["stable"]), results))
     
         print(f"Number of stable iterations: {len(results)}")
     
 
-    largest = max(results, key=lambda x: x[1]["totalModuleWidth"])
-    smallest = min(results, key=lambda x: x[1]["totalModuleWidth"])
+    largest = max(results, key=lambda x: x.totalModuleWidth)
+    smallest = min(results, key=lambda x: x.totalModuleWidth)
+
+    for record, label in ((largest, "Largest"), (smallest, "Smallest")):
+        if (record.trajectoryFile is not None):
+            print(f"{label} module trajectory: {record.trajectoryFile} (replay with python trajectory.py {record.trajectoryFile})")
 
     if (displayResults):
-        largest[0].displayModule(f"Largest: {largest[1]['totalModuleWidth']}mm", False)
-        smallest[0].displayModule(f"Smallest: {smallest[1]['totalModuleWidth']}mm", False)
+        # modules are only rebuilt from their records when they are displayed
+        for record, label in ((largest, "Largest"), (smallest, "Smallest")):
+            module = record.toModule()
+            if (module is not None):
+                module.displayModule(f"{label}: {record.totalModuleWidth}mm (seed {record.seed})", False)
 
         showHistogram(results)
     
@@ -74,5 +157,7 @@ def runSimulation(numIterations:int, displayResults:bool=True) -> List[Tuple[Mod
 
 
 if __name__ == "__main__":
+    import visualisation
+
     runSimulation(modelParameters.MODEL_NUM_ITERATIONS, True)
-    plt.show()
\ No newline at end of file
+    visualisation.show()
\ No newline at end of file
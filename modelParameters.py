@@ -10,12 +10,112 @@ These values should be changed to match reality.
 
 # Number of Iterations
 MODEL_NUM_ITERATIONS = 3
+MODEL_RANDOM_SEED = None # Root seed of a run (see seeding.py). None uses a new seed every run
+
+# Sequential stopping (see stopping.py). Iterations are run until the confidence interval of the statistic of the
+# module width is within +/- MODEL_STOPPING_TOLERANCE
+MODEL_STOPPING_STATISTIC = "mean" # "mean", a percentile such as "p95", or "max"
+MODEL_STOPPING_MAX_QUANTILE = 0.99 # quantile used as the "max" statistic
+MODEL_STOPPING_TOLERANCE = 0.05 # mm
+MODEL_STOPPING_CONFIDENCE = 0.95
+MODEL_STOPPING_MIN_ITERATIONS = 10
+MODEL_STOPPING_MAX_ITERATIONS = 1000
+
+# Sampling of the cell tolerances over the iterations of a run (see sampling.py)
+SAMPLING_RANDOM = "random" # independent random samples
+SAMPLING_ANTITHETIC = "antithetic" # pairs of iterations with mirrored samples
+SAMPLING_LATIN_HYPERCUBE = "lhs" # latin hypercube over the iterations of a run
+SAMPLING_SOBOL = "sobol" # scrambled sobol sequence, requires scipy
+SAMPLING_STRATEGY = SAMPLING_RANDOM
 
 # Final Velocity Tolerance
 MODEL_MAX_STEPS = 17000 # Maximum number of steps before exit
 MODEL_MIN_VELOCITY = 0.2 # lower this number to increase accuracy. The lower the number, the longer the runtime. Must be > 0
 MODEL_IN_VELOCITY_THRESHOLD_COUNT = 500
 
+# Simulation time step
+MODEL_STEP_DT = 0.001 # Fixed simulation step (s). Also used as the step once close to stable in adaptive mode
+MODEL_ADAPTIVE_STEPPING = False # Take larger steps while bandoliers are apart and shrink them as they approach contact
+MODEL_ADAPTIVE_DT_MIN = 0.001 # Smallest adaptive step (s), used from the first contact between bandoliers onwards
+MODEL_ADAPTIVE_DT_MAX = 0.005 # Largest adaptive step (s), used while bandoliers are far apart
+MODEL_ADAPTIVE_CONTACT_DISTANCE = 0.5 # mm. Clearance between neighbouring bandoliers below which they are treated as in contact
+MODEL_ADAPTIVE_MAX_APPROACH_FRACTION = 0.25 # Fraction of the remaining clearance a bandolier may close in a single step
+MODEL_ADAPTIVE_CHECK_INTERVAL = 5 # Number of steps between bandolier clearance checks
+
+# Simulation engine
+ENGINE_PHYSICS = "physics" # all bandoliers are simulated together until the final bandolier is stable
+ENGINE_SEQUENTIAL = "sequential" # bandoliers are added and settled one at a time, then frozen in place
+ENGINE_GEOMETRIC = "geometric" # no physics, rigid bandoliers are stacked geometrically (see geometricSolver.py)
+SIMULATION_ENGINE = ENGINE_PHYSICS
+
+# Collision broad-phase. The spatial hash suits modules of many similar sized circles, its cell size and number of
+# cells are derived from the cell diameter and module extent (see components.spatialHashDimensions). Measured about
+# 15% slower than the bounding box tree on 11 and 22 bandolier modules (the bodies barely move between steps, which
+# the tree handles well), so the tree is the default
+BROADPHASE_BBTREE = "bbtree" # pymunk's default bounding box tree
+BROADPHASE_SPATIAL_HASH = "spatialHash"
+MODEL_BROADPHASE = BROADPHASE_BBTREE
+
+# Body sleeping. Bodies that have been idle for MODEL_SLEEP_TIME_THRESHOLD are removed from the solver, and the
+# simulation is stable once every dynamic body is asleep (instead of using the velocity threshold above)
+MODEL_SLEEP_ENABLED = False
+MODEL_SLEEP_TIME_THRESHOLD = 0.5 # s
+MODEL_SLEEP_IDLE_SPEED = 0 # mm/s, 0 lets pymunk estimate it from gravity and the step size
+MODEL_SLEEP_CHECK_INTERVAL = 10 # Number of steps between checks of which bodies are asleep
+
+# Early abort of simulations that are not going to converge (see convergence.DivergenceMonitor). The maximum velocity
+# of the watched bandolier is averaged over windows of MODEL_ABORT_WINDOW steps, and the last
+# MODEL_ABORT_AVERAGE_WINDOWS window means are averaged again. After MODEL_ABORT_MIN_STEPS the simulation is aborted as
+# "diverging" if that average is rising, above MODEL_ABORT_MIN_LEVEL and MODEL_ABORT_GROWTH_FACTOR times the lowest it
+# has been. Over 70 seeds of the default and 5 bandolier modules, the average of runs that went on to settle stayed
+# below 2.75 times its lowest and 1.7mm/s, while runs with too wide a BANDO_DESIRED_SPACING grew to 6.5-14 times and
+# 3-7mm/s. Only this kind of divergence is caught. About 1 in 5 runs of the default module never settle, but they
+# wander at the same velocities as the slowest runs that do (which went up to 10000 steps between new lows), so they
+# are not aborted and still run until MODEL_MAX_STEPS
+MODEL_ABORT_ENABLED = False
+MODEL_ABORT_WINDOW = 500 # Number of steps per window
+MODEL_ABORT_AVERAGE_WINDOWS = 4 # Number of window means averaged to judge the trend
+MODEL_ABORT_MIN_STEPS = 2000 # Steps before a simulation can be aborted
+MODEL_ABORT_GROWTH_FACTOR = 5
+MODEL_ABORT_MIN_LEVEL = 10*MODEL_MIN_VELOCITY # mm/s
+
+# Module re-use. Each process builds a module once per set of model parameters and re-randomises it in place for
+# every following iteration instead of building a new one (see components.getModule)
+MODEL_REUSE_MODULES = True
+MODEL_MODULE_CACHE_SIZE = 4 # Number of modules (sets of model parameters) kept per process
+
+# Warm starting of multiModel sweeps (see multiModel.runWarmStarted). Each module starts with its bandoliers where they
+# settled in the nearest earlier design point with the same seed, instead of falling from the loose initial layout.
+# Each bandolier starts MODEL_WARM_START_CLEARANCE further from the first than the previous one, so bandoliers of a
+# design point that needs more room than its neighbour do not start overlapping
+MODEL_WARM_START = False
+MODEL_WARM_START_CLEARANCE = 0.1 # mm
+
+# Analytics level (see analytics.py). Summary analytics are the module width and the end limit distances of each
+# bandolier, detailed analytics add the final cell offsets, bandolier pitch and tilt, and cell contacts
+ANALYTICS_SUMMARY = "summary"
+ANALYTICS_DETAILED = "detailed"
+ANALYTICS_LEVEL = ANALYTICS_SUMMARY
+ANALYTICS_CONTACT_TOLERANCE = 0.01 # mm. Cells of neighbouring bandoliers closer than this are counted as in contact
+
+# Trajectory recording (see trajectory.py). The body positions and angles of every TRAJECTORY_INTERVAL'th step of each
+# model.py simulation are written to a directory of TRAJECTORY_DIRECTORY for each run (named after its root seed, and
+# cleared when the run starts), to be replayed afterwards with trajectory.py. A frame of the default module is about
+# 19kB, so a simulation of 5000 steps is about 2MB
+TRAJECTORY_RECORDING = False
+TRAJECTORY_INTERVAL = 50 # Number of steps between recorded frames
+TRAJECTORY_DIRECTORY = "trajectories"
+
+# Profiling (see profiling.py). Times the phases of a run and writes them to profile.json/profile.csv at its end
+PROFILING_ENABLED = False
+
+# Worker pool (see execution.py). The pool is created once and re-used by every run, its workers are replaced after
+# POOL_MAX_TASKS_PER_CHILD tasks to limit memory creep, and tasks are sent to workers POOL_CHUNKSIZE at a time
+POOL_PROCESSES = None # None uses every CPU
+POOL_CHUNKSIZE = None # None sizes chunks to the number of tasks, up to POOL_MAX_CHUNKSIZE
+POOL_MAX_CHUNKSIZE = 16
+POOL_MAX_TASKS_PER_CHILD = 500 # None keeps workers for the life of the pool
+
 # If the model is not stable (ie, velocities are not in range) discard result
 DISCARD_UNSTABLE_RESULTS = True
 
@@ -241,6 +341,26 @@ class ModelParams:
    END_CONSTRAINT_INCLUDE_Y_CONSTRAINTS:bool = END_CONSTRAINT_INCLUDE_Y_CONSTRAINTS
    END_LIMIT_LOWER_Y:float = END_LIMIT_LOWER_Y
    END_LIMIT_UPPER_Y:float = END_LIMIT_UPPER_Y
+   MODEL_STEP_DT:float = MODEL_STEP_DT
+   MODEL_ADAPTIVE_STEPPING:bool = MODEL_ADAPTIVE_STEPPING
+   MODEL_ADAPTIVE_DT_MIN:float = MODEL_ADAPTIVE_DT_MIN
+   MODEL_ADAPTIVE_DT_MAX:float = MODEL_ADAPTIVE_DT_MAX
+   MODEL_ADAPTIVE_CONTACT_DISTANCE:float = MODEL_ADAPTIVE_CONTACT_DISTANCE
+   MODEL_ADAPTIVE_MAX_APPROACH_FRACTION:float = MODEL_ADAPTIVE_MAX_APPROACH_FRACTION
+   MODEL_ADAPTIVE_CHECK_INTERVAL:int = MODEL_ADAPTIVE_CHECK_INTERVAL
+   SIMULATION_ENGINE:str = SIMULATION_ENGINE
+   SAMPLING_STRATEGY:str = SAMPLING_STRATEGY
+   MODEL_BROADPHASE:str = MODEL_BROADPHASE
+   MODEL_SLEEP_ENABLED:bool = MODEL_SLEEP_ENABLED
+   MODEL_SLEEP_TIME_THRESHOLD:float = MODEL_SLEEP_TIME_THRESHOLD
+   MODEL_SLEEP_IDLE_SPEED:float = MODEL_SLEEP_IDLE_SPEED
+   MODEL_SLEEP_CHECK_INTERVAL:int = MODEL_SLEEP_CHECK_INTERVAL
+   MODEL_ABORT_ENABLED:bool = MODEL_ABORT_ENABLED
+   MODEL_ABORT_WINDOW:int = MODEL_ABORT_WINDOW
+   MODEL_ABORT_AVERAGE_WINDOWS:int = MODEL_ABORT_AVERAGE_WINDOWS
+   MODEL_ABORT_MIN_STEPS:int = MODEL_ABORT_MIN_STEPS
+   MODEL_ABORT_GROWTH_FACTOR:float = MODEL_ABORT_GROWTH_FACTOR
+   MODEL_ABORT_MIN_LEVEL:float = MODEL_ABORT_MIN_LEVEL
 
 
 
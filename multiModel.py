@@ -9,49 +9,100 @@ Very similar to model.py, however allows for the simulation of multiple variatio
 run to allow for iterative design. Before running this file, enter the design range of the parameters in the 
 function 'varyModelInputs()'. Functions simulate each design input model multiple times. Allows for the
 monte-carlo simulation where a new module (with its cell positioning tolerances) is created each iteration.
-All results from this program are entered into the file results.txt. This program uses multiprocessing, so
-it may slow down your computer and fill up RAM while it is running. I recommend closing most other apps before use.
+All results from this program are written to the results store by the parent process (see resultsWriter.py) and
+exported to results.csv. This program uses multiprocessing, so it may slow down your computer and fill up RAM while
+it is running. I recommend closing most other apps before use.
 """
 
 import numpy as np
 import itertools
-from typing import Any, Dict
+import hashlib
+import json
+from dataclasses import asdict
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-import csv
-
-from multiprocessing import Pool, Lock
+from multiprocessing.pool import Pool
 from tqdm import tqdm
 
+import execution
 import modelParameters
-from components import Module
+import profiling
+from components import getModule, warmStartOrigins
 from simulation import simulateModule, simulationAnalytics
+import geometricSolver
+import resultsWriter
+import sampling
+import seeding
+import stopping
 
-RESULTS_FILE_NAME = "results.csv"
-
-def worker(modelInputs:Dict[str,Any]) -> bool:
-    currParams = modelParameters.ModelParams(**modelInputs)
-    newModule = Module(modelParams=currParams)
-    stable = simulateModule(newModule,includeProgressBar=False)
+RESULTS_FILE_NAME = resultsWriter.RESULTS_CSV_NAME
+EXPORT_CSV = True # export the results store to RESULTS_FILE_NAME once the sweep is finished
 
-    # get resultDict
-    analytics = simulationAnalytics(newModule, stable)
+# Flatten the model inputs and analytics of a single iteration into a results row
+def resultRow(modelInputs:Dict[str,Any], analytics:Dict[str,Any]) -> Dict[str,Any]:
     results = list(modelInputs.items())
-    results.extend(filter(lambda x: (x[0]!="bandoliers"), analytics.items()))
+    results.extend(filter(lambda x: (x[0] not in ("bandoliers", "cells")), analytics.items())) # per cell arrays are not written
     for i, bando in enumerate(analytics["bandoliers"]):
         results.extend([(f"Bando{i+1}_{key}", value) for key,value in bando.items() ])
     
-    results=dict(results)
-    fieldNames = list(results.keys())
-    
-    with Lock():
-        with open(RESULTS_FILE_NAME, 'a', newline='') as file:
-            writer = csv.DictWriter(file, fieldnames=fieldNames)
+    return dict(results)
+
+# Stable key of a single task (a design point and monte-carlo iteration), used to skip completed tasks when resuming.
+# The key is a hash of every ModelParams field (including those left at their defaults), the iteration and the root
+# seed, so a sweep resumed with a different seed does not pick up results sampled from a different stream. The number
+# of iterations is only hashed for the strategies whose samples depend on it (see sampling.ITERATION_COUNT_STRATEGIES),
+# so other sweeps can be resumed with more iterations
+def taskKey(modelInputs:Dict[str,Any], iteration:int, rootSeed:int, numIterations:int) -> str:
+    params = asdict(modelParameters.ModelParams(**modelInputs))
+    params = {name:(value.item() if isinstance(value, np.generic) else value) for name, value in params.items()}
+
+    key = [params, int(iteration), int(rootSeed)]
+    if (params["SAMPLING_STRATEGY"] in sampling.ITERATION_COUNT_STRATEGIES):
+        key.append(int(numIterations))
 
-            writer.writerow(results)
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+# Raise if a resumed results store holds results that are not tasks of this sweep (with the keys of its tasks). They
+# were simulated with a different root seed, design points or (for some strategies) number of iterations, so
+# appending would mix two sweeps in one store
+def checkResumable(completed:Dict[str,Any], keys:set) -> None:
+    unknown = len(set(completed.get("taskKey", [])) - keys)
+    if (unknown > 0):
+        raise ValueError(f"The results store holds {unknown} results that are not part of this sweep (a different root seed, design points or number of iterations). Run without resume to start a new store")
+
+# Key of the settled bandolier origins returned with the rows of a warm started sweep (not written to the results)
+SETTLED_ORIGINS_KEY = "settledOrigins"
+
+# Simulate a single (modelInputs, iteration, rootSeed, numIterations) task, returning its results row (rows are written
+# by the parent process). The tolerance samples do not depend on the design point, so every design point of a sweep is
+# simulated with the same samples. Tasks of a warm started sweep have a fifth element, the settled origins to warm
+# start from (empty for a cold start), and their rows include the settled origins of the simulated module. Rows record
+# whether the module was warm started
+def worker(task:Tuple[Dict[str,Any], int, int, int]) -> Dict[str,Any]:
+    modelInputs, iteration, rootSeed, numIterations = task[:4]
+    warmStart = task[4] if len(task) > 4 else None
+    currParams = modelParameters.ModelParams(**modelInputs)
+    seed = seeding.iterationSeed(rootSeed, iteration)
+    tolerances = sampling.iterationTolerances(currParams, rootSeed, iteration, numIterations)
+
+    # get resultDict
+    if (currParams.SIMULATION_ENGINE == modelParameters.ENGINE_GEOMETRIC):
+        analytics = geometricSolver.solveModule(currParams, tolerances)
+        stable = analytics["stable"]
+    else:
+        newModule = getModule(currParams, tolerances, bandoOrigins=warmStartOrigins(warmStart, currParams) if warmStart else None)
+        stable = simulateModule(newModule,includeProgressBar=False)
+
+        with profiling.timer("analytics"):
+            analytics = simulationAnalytics(newModule, stable)
 
     # print("Stable result\r" if stable else "Unstable result")
 
-    return stable
+    row = {"taskKey":taskKey(modelInputs, iteration, rootSeed, numIterations), "iteration":iteration, "rootSeed":rootSeed, "seed":seed, "warmStarted":bool(warmStart), **resultRow(modelInputs, analytics)}
+    if (warmStart is not None and stable and currParams.SIMULATION_ENGINE != modelParameters.ENGINE_GEOMETRIC):
+        row[SETTLED_ORIGINS_KEY] = newModule.getSettledOrigins()
+
+    return row
 
 def product_dict(**kwargs):
     keys = kwargs.keys()
@@ -83,6 +134,8 @@ def varyModelInputs():
     END_CONSTRAINT_UPPER_X:float = r(modelParameters.END_CONSTRAINT_UPPER_X, modelParameters.END_CONSTRAINT_UPPER_X+0, 1) 
     END_CONSTRAINT_LOWER_Y:float = r(modelParameters.END_CONSTRAINT_LOWER_Y, modelParameters.END_CONSTRAINT_LOWER_Y+0, 1) 
     END_CONSTRAINT_UPPER_Y:float = r(modelParameters.END_CONSTRAINT_UPPER_Y, modelParameters.END_CONSTRAINT_UPPER_Y+0, 1)
+    SIMULATION_ENGINE:str = [modelParameters.SIMULATION_ENGINE] # see modelParameters.py for the engines
+    SAMPLING_STRATEGY:str = [modelParameters.SAMPLING_STRATEGY] # see modelParameters.py for the strategies
 
 
     return list(product_dict(BANDO_CELL_X = BANDO_CELL_X,
@@ -100,33 +153,176 @@ def varyModelInputs():
                             END_CONSTRAINT_LOWER_X = END_CONSTRAINT_LOWER_X,
                             END_CONSTRAINT_UPPER_X = END_CONSTRAINT_UPPER_X,
                             END_CONSTRAINT_LOWER_Y = END_CONSTRAINT_LOWER_Y,
-                            END_CONSTRAINT_UPPER_Y = END_CONSTRAINT_UPPER_Y))
+                            END_CONSTRAINT_UPPER_Y = END_CONSTRAINT_UPPER_Y,
+                            SIMULATION_ENGINE = SIMULATION_ENGINE,
+                            SAMPLING_STRATEGY = SAMPLING_STRATEGY))
 
-def runMultiModel(numIterations:int, displayResults:bool=True):
-    pool = Pool()
+# Run every design point numIterations times. With resume, tasks already in the results store (from an interrupted
+# or smaller sweep) are skipped and new results are appended, otherwise the store is cleared. A store of a different
+# sweep is not resumed (see checkResumable). Results are checkpointed every resultsWriter.RESULTS_FLUSH_ROWS rows or
+# RESULTS_FLUSH_SECONDS, and on exit (including Ctrl-C). seed is the root seed of the sweep (see seeding.py), a resumed
+# sweep uses the root seed it was started with unless seed is given. With warmStart, modules start from where the
+# bandoliers of a similar design point settled in the same iteration (see runWarmStarted)
+def runMultiModel(numIterations:int, displayResults:bool=True, engine:str=None, resume:bool=False, seed:int=None, warmStart:bool=modelParameters.MODEL_WARM_START):
+    profiling.reset()
+    inputList, completed, rootSeed = setupSweep(engine, resume, seed)
+    pool = execution.getPool([modelParameters.ModelParams(**modelInput) for modelInput in inputList[:modelParameters.MODEL_MODULE_CACHE_SIZE]])
 
-    inputList = varyModelInputs()
+    tasks = [(modelInput, iteration, rootSeed, numIterations) for modelInput in inputList for iteration in range(numIterations)]
+    completedIterations:List[set] = [set() for _ in inputList]
+
+    if (resume):
+        keys = [taskKey(*task) for task in tasks]
+        checkResumable(completed, set(keys))
+
+        completedKeys = set(completed.get("taskKey", []))
+        for index, key in enumerate(keys):
+            if (key in completedKeys):
+                completedIterations[index//numIterations].add(index%numIterations)
+        tasks = [task for task, key in zip(tasks, keys) if key not in completedKeys]
+
+        print(f"Resuming, {len(inputList)*numIterations-len(tasks)} of {len(inputList)*numIterations} iterations already complete")
+
+    numStable = 0
+    with resultsWriter.ResultsWriter(append=resume) as writer, tqdm(total=len(tasks), unit="Iteration", desc="MultiModel") as progressBar:
+        def onResult(output:Any) -> Dict[str,Any]:
+            nonlocal numStable
+            row = profiling.mergeResult(output)
+            with profiling.timer("resultsWrite"):
+                writer.write({name:value for name, value in row.items() if name != SETTLED_ORIGINS_KEY})
+            numStable += row["stable"]
+
+            return row
+
+        if (warmStart):
+            runWarmStarted(pool, profiling.profiledWorker(worker), inputList, numIterations, rootSeed, onResult, completedIterations, progressBar)
+        else:
+            for output in pool.imap_unordered(profiling.profiledWorker(worker), tasks, execution.chunkSize(len(tasks))):
+                onResult(output)
+                progressBar.update(1)
+
+    print(f"Number of stable iterations: {numStable}")
+
+    if (EXPORT_CSV):
+        with profiling.timer("csvExport"):
+            resultsWriter.exportCSV(csvFileName=RESULTS_FILE_NAME)
+
+    profiling.writeProfile()
+
+# Run every design point until the statistic of its module width has converged to within +/- tolerance (see
+# stopping.py), instead of a fixed number of iterations. Design points that converge early stop being submitted, so
+# the workers move on to the remaining ones. Resuming works as in runMultiModel, with the completed iterations of
+# each design point counted towards its statistic
+def runMultiModelUntilConverged(statistic:str=modelParameters.MODEL_STOPPING_STATISTIC, tolerance:float=modelParameters.MODEL_STOPPING_TOLERANCE, confidence:float=modelParameters.MODEL_STOPPING_CONFIDENCE, displayResults:bool=True, engine:str=None, resume:bool=False, seed:int=None):
+    profiling.reset()
+    inputList, completed, rootSeed = setupSweep(engine, resume, seed)
+    pool = execution.getPool([modelParameters.ModelParams(**modelInput) for modelInput in inputList[:modelParameters.MODEL_MODULE_CACHE_SIZE]])
+    rules = [stopping.StoppingRule(statistic, tolerance, confidence) for _ in inputList]
+
+    # completed iterations of each design point, and their widths
+    completedWidths = dict(zip(completed.get("taskKey", []), zip(completed.get("stable", []), completed.get("totalModuleWidth", []))))
+    completedIterations:List[set] = []
+    keys = set()
+    for modelInput, rule in zip(inputList, rules):
+        iterations = set()
+        for iteration in range(rule.maxIterations):
+            key = taskKey(modelInput, iteration, rootSeed, rule.maxIterations)
+            keys.add(key)
+            if (key in completedWidths):
+                iterations.add(iteration)
+                stable, width = completedWidths[key]
+                if (stable or not modelParameters.DISCARD_UNSTABLE_RESULTS):
+                    rule.add(float(width))
+
+        completedIterations.append(iterations)
+
+    checkResumable(completed, keys)
+
+    numStable = 0
+    with resultsWriter.ResultsWriter(append=resume) as writer, tqdm(unit="Iteration", desc="MultiModel") as progressBar:
+        def onResult(design:int, output:Any) -> float:
+            nonlocal numStable
+            row = profiling.mergeResult(output)
+            with profiling.timer("resultsWrite"):
+                writer.write(row)
+            numStable += row["stable"]
+            if (modelParameters.DISCARD_UNSTABLE_RESULTS and not row["stable"]):
+                return None
+
+            return row["totalModuleWidth"]
+
+        stopping.runSequentially(pool, profiling.profiledWorker(worker), lambda design, iteration: (inputList[design], iteration, rootSeed, rules[design].maxIterations),
+                                 rules, onResult, completedIterations=completedIterations, progressBar=progressBar)
 
-    fieldNames = list(inputList[0].keys())
-    fieldNames.extend(["stable", "totalModuleWidth"])
-    [fieldNames.append(f"Bando{i+1}_{key}") for i in range(modelParameters.MODULE_BANDO_COUNT) for key in ["upperDistanceX", "upperDistanceY", "lowerDistanceX", "lowerDistanceY"]]
-    with Lock():
-        with open(RESULTS_FILE_NAME, 'w', newline='') as file:
-            writer = csv.DictWriter(file, fieldnames=fieldNames)
-            writer.writeheader()
-
-    results = list(tqdm(pool.imap_unordered(worker, 
-                                        [modelInput for modelInput in inputList for _ in range(numIterations)]),
-                    total=len(inputList)*numIterations,
-                    unit="Iteration", 
-                    desc="MultiModel",
-                    disable=False))
-        
-    numStable = results.count(True)
-    
     print(f"Number of stable iterations: {numStable}")
+    print(f"Design points converged: {sum(rule.converged() for rule in rules)}/{len(rules)}")
+
+    if (EXPORT_CSV):
+        with profiling.timer("csvExport"):
+            resultsWriter.exportCSV(csvFileName=RESULTS_FILE_NAME)
+
+    profiling.writeProfile()
+
+# Design point each design point of a warm started sweep is warm started from (None for a cold start): the nearest
+# earlier design point with the same value of every non-float input. Design points are compared by their float inputs
+# (scaled by their range in the sweep), and ties go to the latest, so on a grid it is the previous grid point. Only
+# earlier design points are used, so every task of an iteration can wait for the one it is warm started from
+def warmStartPredecessors(inputList:List[Dict[str,Any]]) -> List[Optional[int]]:
+    floatInputs = [name for name, value in inputList[0].items() if isinstance(value, (float, np.floating))] if len(inputList) > 0 else []
+    scales = {name:(max(x[name] for x in inputList)-min(x[name] for x in inputList)) or 1 for name in floatInputs}
+
+    predecessors = []
+    for design, modelInputs in enumerate(inputList):
+        candidates = [(sum(((modelInputs[name]-inputList[other][name])/scales[name])**2 for name in floatInputs), -other)
+                      for other in range(design)
+                      if all(inputList[other][name] == value for name, value in modelInputs.items() if name not in scales)]
+
+        predecessors.append(-min(candidates)[1] if len(candidates) > 0 else None)
+
+    return predecessors
+
+# Run numIterations iterations of every design point with warm starts (see stopping.runSequentially), passing the
+# output of the (possibly profiled, see profiling.py) worker to onResult, which returns its row. Each task waits for
+# the same iteration of its predecessor (see warmStartPredecessors) and is warm started from where its bandoliers
+# settled, so a sweep simulates the same modules whatever order tasks complete in. Tasks start cold if the
+# predecessor was unstable, or was completed before the sweep was resumed (in completedIterations)
+def runWarmStarted(pool:Pool, worker:Any, inputList:List[Dict[str,Any]], numIterations:int, rootSeed:int, onResult:Callable[[Any], Dict[str,Any]], completedIterations:List[set], progressBar:Any = None) -> None:
+    predecessors = warmStartPredecessors(inputList)
+    done = {(design, iteration) for design, iterations in enumerate(completedIterations) for iteration in iterations}
+    settled:Dict[Tuple[int, int], List[float]] = {} # settled origins of completed tasks by (design, iteration)
+
+    def ready(design:int, iteration:int) -> bool:
+        return predecessors[design] is None or (predecessors[design], iteration) in done
+
+    def makeTask(design:int, iteration:int) -> Tuple[Dict[str,Any], int, int, int, List[float]]:
+        return (inputList[design], iteration, rootSeed, numIterations, settled.get((predecessors[design], iteration), []))
+
+    def onDesignResult(design:int, output:Any) -> None:
+        row = onResult(output)
+        done.add((design, row["iteration"]))
+        if (SETTLED_ORIGINS_KEY in row):
+            settled[(design, row["iteration"])] = row[SETTLED_ORIGINS_KEY]
+
+    rules = [stopping.StoppingRule(maxIterations=numIterations) for _ in inputList]
+    stopping.runSequentially(pool, worker, makeTask, rules, onDesignResult, completedIterations=completedIterations, progressBar=progressBar, ready=ready)
+
+# Design points of a sweep, the results already in the store (if resuming) and the root seed of the sweep
+def setupSweep(engine:str=None, resume:bool=False, seed:int=None) -> Tuple[List[Dict[str,Any]], Dict[str,Any], int]:
+    inputList = varyModelInputs()
+    if (engine is not None):
+        for modelInput in inputList:
+            modelInput["SIMULATION_ENGINE"] = engine
+
+    completed = resultsWriter.loadColumns() if resume else {}
+    if (seed is None and len(completed.get("rootSeed", [])) > 0):
+        seed = int(completed["rootSeed"][0])
+
+    rootSeed = seeding.rootSeed(seed)
+    print(f"Root seed: {rootSeed}")
+
+    return (inputList, completed, rootSeed)
             
 
 if __name__ == "__main__":
-    runMultiModel(modelParameters.MODEL_NUM_ITERATIONS)
+    runMultiModel(modelParameters.MODEL_NUM_ITERATIONS, resume=False)
 
@@ -0,0 +1,135 @@
+###############
+# profiling.py
+# TOM WRIGHT 2021
+###############
+
+"""
+Optional instrumentation of where the time of a run goes (PROFILING_ENABLED in modelParameters.py). Phases of the
+simulation (module build or reset, physics steps, convergence checks, analytics, geometric solving, result pickling
+and results store/CSV writing) are timed, and counters are kept of steps to stability, bodies and constraints
+simulated and bytes returned per task. Each process keeps its own profile. Pool workers are wrapped with
+profiledWorker(), which sends the profile of each task back with its result, and the parent merges them with
+mergeResult() and writes the whole profile to profile.json and profile.csv at the end of the run. With profiling off
+the timers are a shared no-op context, profiledWorker() returns the worker unchanged and nothing is sent back.
+"""
+
+import contextlib
+import csv
+import json
+import pickle
+import time
+from typing import Any, Callable, ContextManager, Dict, List, Tuple
+
+import modelParameters
+
+PROFILE_JSON_NAME = "profile.json"
+PROFILE_CSV_NAME = "profile.csv"
+
+timers:Dict[str, List[float]] = {} # phase: [calls, seconds]
+counters:Dict[str, float] = {}
+
+NULL_TIMER = contextlib.nullcontext()
+
+
+def enabled() -> bool:
+    return modelParameters.PROFILING_ENABLED
+
+def reset() -> None:
+    timers.clear()
+    counters.clear()
+
+def addTime(phase:str, seconds:float, calls:int = 1) -> None:
+    entry = timers.setdefault(phase, [0, 0.0])
+    entry[0] += calls
+    entry[1] += seconds
+
+def count(counter:str, value:float = 1) -> None:
+    counters[counter] = counters.get(counter, 0) + value
+
+@contextlib.contextmanager
+def phaseTimer(phase:str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        addTime(phase, time.perf_counter()-start)
+
+# Time a phase, eg. "with profiling.timer("analytics"):". A no-op if profiling is off
+def timer(phase:str) -> ContextManager:
+    if (not modelParameters.PROFILING_ENABLED):
+        return NULL_TIMER
+
+    return phaseTimer(phase)
+
+def snapshot() -> Dict[str, Dict[str, Any]]:
+    return {"timers":{phase:list(entry) for phase, entry in timers.items()}, "counters":dict(counters)}
+
+def merge(profile:Dict[str, Dict[str, Any]]) -> None:
+    for phase, (calls, seconds) in profile["timers"].items():
+        addTime(phase, seconds, calls)
+    for counter, value in profile["counters"].items():
+        count(counter, value)
+
+
+# Pool worker that returns (result, profile of the task), the profile includes the size of the pickled result
+class ProfiledWorker:
+    def __init__(self, worker:Callable[[Any], Any]) -> None:
+        self.worker = worker
+
+    def __call__(self, task:Any) -> Tuple[Any, Dict[str, Dict[str, Any]]]:
+        reset()
+        with phaseTimer("task"):
+            result = self.worker(task)
+
+        with phaseTimer("resultPickling"):
+            count("resultBytes", len(pickle.dumps(result, pickle.HIGHEST_PROTOCOL)))
+        count("tasks")
+
+        return (result, snapshot())
+
+def profiledWorker(worker:Callable[[Any], Any]) -> Callable[[Any], Any]:
+    if (not modelParameters.PROFILING_ENABLED):
+        return worker
+
+    return ProfiledWorker(worker)
+
+# Result of a task run by profiledWorker(), merging its profile into this process's profile
+def mergeResult(output:Any) -> Any:
+    if (not modelParameters.PROFILING_ENABLED):
+        return output
+
+    result, profile = output
+    merge(profile)
+
+    return result
+
+
+# Rows of the profile, one per phase (calls, total and mean seconds) and counter (total and mean per task)
+def profileRows() -> List[Dict[str, Any]]:
+    tasks = max(1, counters.get("tasks", 1))
+    rows = [{"name":phase, "kind":"timer", "calls":calls, "total":seconds, "mean":seconds/max(1, calls)} for phase, (calls, seconds) in sorted(timers.items())]
+    rows.extend({"name":counter, "kind":"counter", "calls":"", "total":value, "mean":value/tasks} for counter, value in sorted(counters.items()))
+
+    return rows
+
+# Write the profile of the run to PROFILE_JSON_NAME and PROFILE_CSV_NAME and print it. Does nothing if profiling is off
+def writeProfile(jsonFileName:str = PROFILE_JSON_NAME, csvFileName:str = PROFILE_CSV_NAME) -> None:
+    if (not modelParameters.PROFILING_ENABLED):
+        return
+
+    rows = profileRows()
+
+    with open(jsonFileName, 'w') as file:
+        json.dump(snapshot(), file, indent=4)
+
+    with open(csvFileName, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=["name", "kind", "calls", "total", "mean"])
+        writer.writeheader()
+        writer.writerows(rows)
+
+    for row in rows:
+        print(f"{row['name']:>24}: {row['total']:14.4f} total, {row['mean']:12.6f} mean" + (f" over {row['calls']} calls" if row["kind"] == "timer" else " per task"))
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,140 @@
+###############
+# resultsWriter.py
+# TOM WRIGHT 2021
+###############
+
+"""
+This file can be run independantly (exports the results store to results.csv).
+Columnar store for the results of multiModel sweeps. Workers hand their result rows back to the parent process,
+where a single ResultsWriter buffers them and writes them out in chunks, one compressed numpy .npz file per chunk
+with an array per column. A chunk is written once enough rows are buffered or enough time has passed since the
+last write, so a crashed sweep loses at most one chunk. Chunks also act as checkpoints, a store can be appended to
+when a sweep is resumed (see multiModel.runMultiModel). The store can be loaded as columns (fast) or rows, and
+exported to CSV.
+"""
+
+import csv
+import glob
+import os
+import time
+from typing import Any, Dict, Iterator, List
+
+import numpy as np
+
+RESULTS_STORE_NAME = "results" # directory the chunks are written to
+RESULTS_CSV_NAME = "results.csv"
+
+# A chunk is written when either threshold is reached
+RESULTS_FLUSH_ROWS = 1000
+RESULTS_FLUSH_SECONDS = 60
+
+CHUNK_PATTERN = "chunk_*.npz"
+
+
+# Chunk files of a store, in the order they were written
+def chunkFiles(storeName:str = RESULTS_STORE_NAME) -> List[str]:
+    return sorted(glob.glob(os.path.join(storeName, CHUNK_PATTERN)))
+
+
+class ResultsWriter:
+    # An existing store is cleared unless append is set. All rows must have the same keys
+    def __init__(self, storeName:str = RESULTS_STORE_NAME, append:bool = False, flushRows:int = RESULTS_FLUSH_ROWS, flushSeconds:float = RESULTS_FLUSH_SECONDS) -> None:
+        self.storeName:str = storeName
+        self.flushRows:int = max(1, flushRows)
+        self.flushSeconds:float = flushSeconds
+
+        os.makedirs(storeName, exist_ok=True)
+        if (not append):
+            for fileName in chunkFiles(storeName):
+                os.remove(fileName)
+
+        existingChunks = chunkFiles(storeName)
+        self.chunkCount:int = int(os.path.basename(existingChunks[-1])[len("chunk_"):-len(".npz")])+1 if len(existingChunks) > 0 else 0
+        self.fieldNames:List[str] = None
+        self.rows:List[Dict[str, Any]] = []
+        self.lastFlush:float = time.monotonic()
+        self.rowCount:int = 0
+
+    def __enter__(self) -> "ResultsWriter":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def write(self, row:Dict[str, Any]) -> None:
+        if (self.fieldNames is None):
+            self.fieldNames = list(row.keys())
+        elif (len(row) != len(self.fieldNames) or any(name not in row for name in self.fieldNames)):
+            raise ValueError("Result row does not have the same fields as the previous rows")
+
+        self.rows.append(row)
+        self.rowCount += 1
+
+        if (len(self.rows) >= self.flushRows or time.monotonic()-self.lastFlush >= self.flushSeconds):
+            self.flush()
+
+    # Write the buffered rows as a new chunk. The chunk is written to a temporary file first (which is not matched by
+    # CHUNK_PATTERN), so a chunk file is never left half written
+    def flush(self) -> None:
+        self.lastFlush = time.monotonic()
+        if (len(self.rows) == 0):
+            return
+
+        columns = {name:np.array([row[name] for row in self.rows]) for name in self.fieldNames}
+
+        fileName = os.path.join(self.storeName, f"chunk_{self.chunkCount:06d}.npz")
+        temporaryFileName = fileName + ".tmp"
+        with open(temporaryFileName, 'wb') as file:
+            np.savez_compressed(file, **columns)
+        os.replace(temporaryFileName, fileName)
+
+        self.chunkCount += 1
+        self.rows = []
+
+    def close(self) -> None:
+        self.flush()
+
+
+# Every column of a store, concatenated over its chunks
+def loadColumns(storeName:str = RESULTS_STORE_NAME) -> Dict[str, np.ndarray]:
+    chunks:List[Dict[str, np.ndarray]] = []
+    for fileName in chunkFiles(storeName):
+        with np.load(fileName, allow_pickle=False) as chunk:
+            chunks.append({name:chunk[name] for name in chunk.files})
+
+    if (len(chunks) == 0):
+        return {}
+
+    return {name:np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0].keys()}
+
+# Rows of a store as dictionaries of python values (in the same form as written by multiModel)
+def iterateRows(storeName:str = RESULTS_STORE_NAME) -> Iterator[Dict[str, Any]]:
+    for fileName in chunkFiles(storeName):
+        with np.load(fileName, allow_pickle=False) as chunk:
+            columns = {name:chunk[name].tolist() for name in chunk.files}
+
+        for values in zip(*columns.values()):
+            yield dict(zip(columns.keys(), values))
+
+def loadRows(storeName:str = RESULTS_STORE_NAME) -> List[Dict[str, Any]]:
+    return list(iterateRows(storeName))
+
+# Write a store to a CSV file, one chunk at a time
+def exportCSV(storeName:str = RESULTS_STORE_NAME, csvFileName:str = RESULTS_CSV_NAME) -> int:
+    rowCount = 0
+
+    with open(csvFileName, 'w', newline='') as file:
+        writer = None
+        for row in iterateRows(storeName):
+            if (writer is None):
+                writer = csv.DictWriter(file, fieldnames=list(row.keys()))
+                writer.writeheader()
+
+            writer.writerow(row)
+            rowCount += 1
+
+    return rowCount
+
+
+if __name__ == "__main__":
+    print(f"Exported {exportCSV()} rows to {RESULTS_CSV_NAME}")
@@ -0,0 +1,131 @@
+###############
+# sampling.py
+# TOM WRIGHT 2021
+###############
+
+"""
+Sampling strategies for the cell tolerances of monte-carlo iterations (SAMPLING_STRATEGY in modelParameters.py).
+Every tolerance of a module (the x offset, y offset and diameter of every cell) is one dimension of the sample, and
+the strategies spread the iterations of a run over these dimensions more evenly than independent random draws, so
+the statistics of the results converge with fewer iterations:
+    random - independent normal draws from each iteration's seed (see seeding.py)
+    antithetic - iterations are taken in pairs, the second of each pair uses the negated draws of the first
+    lhs - latin hypercube, each dimension is split into numIterations equally likely strata, and every stratum is
+          used by exactly one iteration of the run
+    sobol - scrambled sobol sequence (requires scipy). The means of the tolerances converge far faster than random,
+            but a small fraction of the pairs of tolerances are strongly correlated over the iterations of a run
+Uniform samples are mapped to tolerances through the inverse normal CDF. Each iteration's tolerances only depend on
+the root seed, iteration and number of iterations, so they can be sampled independently in any worker.
+"""
+
+from statistics import NormalDist
+from typing import List, Tuple
+
+import numpy as np
+
+import components
+import modelParameters
+import seeding
+
+try:
+    from scipy.special import ndtri
+    from scipy.stats import qmc
+except ImportError:
+    ndtri = None
+    qmc = None
+
+# Strategies whose samples depend on the number of iterations of the run (the other strategies sample the first
+# iterations of a larger run the same as a smaller run)
+ITERATION_COUNT_STRATEGIES = (modelParameters.SAMPLING_LATIN_HYPERCUBE,)
+
+# Rounds of the feistel network used to permute the latin hypercube strata
+LHS_FEISTEL_ROUNDS = 4
+
+TOLERANCES_PER_CELL = 3 # x offset, y offset, diameter
+
+
+def sampleDimensions(modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS) -> Tuple[int, int, int]:
+    return (modelParams.MODULE_BANDO_COUNT, TOLERANCES_PER_CELL, modelParams.BANDO_CELL_COUNT)
+
+# Inverse CDF of the standard normal distribution
+def inverseNormal(uniform:np.ndarray) -> np.ndarray:
+    uniform = np.clip(uniform, 1e-12, 1-1e-12)
+
+    if (ndtri is not None):
+        return ndtri(uniform)
+
+    return np.vectorize(NormalDist().inv_cdf, otypes=[float])(uniform)
+
+# Stratum used by an iteration in each of numDimensions dimensions. Every dimension has its own pseudo random
+# permutation of the numIterations strata (a keyed feistel network, cycle walked to the number of iterations), so the
+# strata of a single iteration are found without storing a permutation of every dimension
+def latinHypercubeStrata(rootSeed:int, iteration:int, numIterations:int, numDimensions:int) -> np.ndarray:
+    halfBits = max(1, int(np.ceil(np.log2(max(numIterations, 2))/2)))
+    halfMask = np.uint64((1 << halfBits)-1)
+    keys = seeding.generator(np.random.SeedSequence(rootSeed, spawn_key=(numIterations, numDimensions))).integers(0, 2**32, (LHS_FEISTEL_ROUNDS, numDimensions), dtype=np.uint64)
+
+    strata = np.full(numDimensions, iteration, dtype=np.uint64)
+    pending = np.ones(numDimensions, dtype=bool)
+    while (np.any(pending)):
+        value = strata[pending]
+        for roundKeys in keys[:, pending]:
+            left, right = value >> np.uint64(halfBits), value & halfMask
+            mixed = ((right ^ roundKeys) * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(32)
+            value = (right << np.uint64(halfBits)) | (left ^ (mixed & halfMask))
+
+        strata[pending] = value
+        pending[pending] = value >= numIterations
+
+    return strata.astype(np.int64)
+
+# Uniform samples of an iteration from a scrambled sobol sequence
+def sobolUniforms(rootSeed:int, iteration:int, numDimensions:int) -> np.ndarray:
+    if (qmc is None):
+        raise ImportError("The sobol sampling strategy requires scipy")
+
+    engine = qmc.Sobol(numDimensions, scramble=True, seed=rootSeed)
+
+    # scipy fails to fast forward by zero points
+    if (iteration > 0):
+        engine.fast_forward(iteration)
+
+    return engine.random(1)[0]
+
+# Standard normal samples of an iteration, shaped as sampleDimensions()
+def standardNormals(modelParams:modelParameters.ModelParams, rootSeed:int, iteration:int, numIterations:int) -> np.ndarray:
+    shape = sampleDimensions(modelParams)
+    numDimensions = int(np.prod(shape))
+    strategy = modelParams.SAMPLING_STRATEGY
+
+    if (strategy == modelParameters.SAMPLING_ANTITHETIC):
+        normals = seeding.generator(seeding.iterationSeed(rootSeed, iteration//2)).standard_normal(numDimensions)
+        normals = normals if iteration%2 == 0 else -normals
+    elif (strategy == modelParameters.SAMPLING_LATIN_HYPERCUBE):
+        jitter = seeding.generator(seeding.iterationSeed(rootSeed, iteration)).random(numDimensions)
+        normals = inverseNormal((latinHypercubeStrata(rootSeed, iteration, numIterations, numDimensions)+jitter)/numIterations)
+    elif (strategy == modelParameters.SAMPLING_SOBOL):
+        normals = inverseNormal(sobolUniforms(rootSeed, iteration, numDimensions))
+    else:
+        raise ValueError(f"Unknown sampling strategy {strategy}")
+
+    return normals.reshape(shape)
+
+# Tolerances of every bandolier of a module (as sampled by components.sampleCellTolerances) for an iteration of a run
+def iterationTolerances(modelParams:modelParameters.ModelParams, rootSeed:int, iteration:int, numIterations:int) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    if (modelParams.SAMPLING_STRATEGY == modelParameters.SAMPLING_RANDOM):
+        return seedTolerances(modelParams, seeding.iterationSeed(rootSeed, iteration))
+
+    return [(modelParams.BANDO_X_MU + modelParams.BANDO_X_SIGMA*xNormals,
+             modelParams.BANDO_Y_MU + modelParams.BANDO_Y_SIGMA*yNormals,
+             modelParams.CELL_DIAMETER_CURRENT + modelParams.CELL_DIAMETER_MU + modelParams.CELL_DIAMETER_SIGMA*diameterNormals)
+            for xNormals, yNormals, diameterNormals in standardNormals(modelParams, rootSeed, iteration, numIterations)]
+
+# Randomly sampled tolerances of a module from a single seed
+def seedTolerances(modelParams:modelParameters.ModelParams, seed:int) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    rng = seeding.generator(seed)
+
+    return [components.sampleCellTolerances(modelParams, rng) for _ in range(modelParams.MODULE_BANDO_COUNT)]
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,42 @@
+###############
+# seeding.py
+# TOM WRIGHT 2021
+###############
+
+"""
+Random number streams for the monte-carlo iterations. Each run has a root seed (MODEL_RANDOM_SEED, or a new one that
+is printed so the run can be repeated), and every iteration gets its own seed spawned from the root seed and the
+iteration number with numpy's SeedSequence. A module is built from a Generator seeded with its iteration seed, so
+pool workers never share a random state, and any result can be re-simulated exactly from the seed recorded with it.
+Iteration seeds do not depend on the design point, so every design point of a multiModel sweep sees the same
+tolerance samples (common random numbers), which reduces the noise when comparing designs.
+"""
+
+from typing import Optional
+
+import numpy as np
+
+import modelParameters
+
+
+# Root seed of a run, seed if given, otherwise MODEL_RANDOM_SEED or a new seed. Seeds are kept to 63 bits so they can
+# be stored as int64
+def rootSeed(seed:Optional[int] = None) -> int:
+    if (seed is None):
+        seed = modelParameters.MODEL_RANDOM_SEED
+
+    if (seed is not None):
+        return int(seed)
+
+    return int(np.random.SeedSequence().generate_state(1, np.uint64)[0] >> 1)
+
+# Seed of a single monte-carlo iteration of a run
+def iterationSeed(root:int, iteration:int) -> int:
+    return int(np.random.SeedSequence(root, spawn_key=(int(iteration),)).generate_state(1, np.uint64)[0] >> 1)
+
+def generator(seed:Optional[int] = None) -> np.random.Generator:
+    return np.random.default_rng(seed)
+
+
+if __name__ == "__main__":
+    pass
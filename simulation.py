@@ -12,116 +12,197 @@ simulation/model works. The simulation will run on the input module. Analytics c
 determine the total width, bandolier positions, etc.
 """
 
-import matplotlib.pyplot as plt
-from matplotlib import animation
 import numpy as np
+from dataclasses import dataclass
+import time
+from typing import Any, Dict, List, Optional, Tuple
 
 from tqdm import tqdm
 
-import pymunk
-import pymunk.matplotlib_util
-
+import analytics as moduleAnalytics
 import components
 import modelParameters
+import profiling
+from convergence import ConvergenceDetector, createDetector
+from stepping import createStepper
+from trajectory import TrajectoryRecorder
 
-def simulateModule(module:components.Module, displayFigure:bool=False, animateSimulation:bool=False, numberOfSimSteps:int=-1,simulationTitle="",includeProgressBar=True, progressBarLeave=True)->bool:
+def simulateModule(module:components.Module, displayFigure:bool=False, animateSimulation:bool=False, numberOfSimSteps:int=-1,simulationTitle="",includeProgressBar=True, progressBarLeave=True, detector:ConvergenceDetector=None, recorder:TrajectoryRecorder=None)->bool:
     modelParams:modelParameters.ModelParams = module.modelParams
     stable = False
 
-    def init():
-        module.space.debug_draw(drawOption)
-        return []
-
-    def animate(_):
-        ax.clear()
-        ax.set_xlim(figureXLim[0],figureXLim[1])
-        ax.set_ylim(figureYLim[0],figureYLim[1])
-
-        for x in range(stepsPerFrame):
-            module.space.step(0.001)
-
-        module.space.debug_draw(drawOption)
-        
-
     if (displayFigure and animateSimulation):
         if (numberOfSimSteps < 0):
             numberOfSimSteps = 5000
 
-        leftMostX = min([cell.simXPos for cell in module.bandoliers[0].cells])
-        rightMostX = max([cell.simXPos for cell in module.bandoliers[-1].cells])
-        bottomMostY = min([bando.cells[0].simYPos for bando in module.bandoliers])
-        topMostY = max([bando.cells[-1].simYPos for bando in module.bandoliers])
-        figureXLim = (leftMostX-25, rightMostX+25)
-        figureYLim = (bottomMostY-25, topMostY+25)
-        
-        stepsPerFrame = 10
-
-        fig = plt.figure()
-        ax = plt.axes(xlim=figureXLim, ylim=figureYLim)
-        ax.set_aspect("equal")
-
-        drawOption = pymunk.matplotlib_util.DrawOptions(ax)
-        drawOption.flags = pymunk.SpaceDebugDrawOptions.DRAW_SHAPES | \
-                            pymunk.SpaceDebugDrawOptions.DRAW_COLLISION_POINTS | \
-                            (pymunk.SpaceDebugDrawOptions.DRAW_CONSTRAINTS if modelParameters.DISPLAY_CONSTRAINTS else 0)
-
-        frames = numberOfSimSteps/stepsPerFrame
-        anim = animation.FuncAnimation(fig, animate, init_func=init, frames=int(frames), interval=10, blit=False, repeat=False)
-        plt.show()
+        import visualisation
+        visualisation.animateSimulation(module, numberOfSimSteps)
     else:
-        finalBandoVelocities = []
-        countInTreshold = 0
+        # Velocity history is only kept when it is going to be plotted
+        if (detector is None):
+            detector = createDetector(modelParams, keepHistory=displayFigure)
+
+        if (profiling.enabled()):
+            profiling.count("bodies", len(module.space.bodies))
+            profiling.count("constraints", len(module.space.constraints))
+
+        if (modelParams.SIMULATION_ENGINE == modelParameters.ENGINE_SEQUENTIAL):
+            stable, velocityHistory = simulateSequentially(module, detector, numberOfSimSteps, simulationTitle, includeProgressBar, progressBarLeave, recorder)
+        else:
+            stable, module.simulationSteps, module.simulatedTime = stepSimulation(module, module.bandoliers[-1], [bando for bando in module.bandoliers if not bando.static], detector, numberOfSimSteps, simulationTitle, includeProgressBar, progressBarLeave, recorder)
+            velocityHistory = detector.history
+
+            module.sleepingBodies = detector.sleepingBodies
+            module.firstSleepStep = detector.firstSleepStep
+            module.allAsleepStep = detector.allAsleepStep
+            module.abortReason = detector.abortReason
+
+        if (profiling.enabled()):
+            profiling.count("simulations")
+            profiling.count("stableSimulations", stable)
+            profiling.count("steps", module.simulationSteps)
+            if (stable):
+                profiling.count("stepsToStability", module.simulationSteps)
+            if (module.abortReason):
+                profiling.count("abortedSimulations")
 
-        stepDt = 0.001
+        if (displayFigure):
+            import visualisation
 
+            stableString = "Stability Ignored" if numberOfSimSteps > 0 else str(stable)
+            visualisation.plotVelocityHistory(velocityHistory, stableString)
 
-        for x in tqdm(range(modelParameters.MODEL_MAX_STEPS if numberOfSimSteps < 0 else numberOfSimSteps), desc=simulationTitle, leave=progressBarLeave, unit="step", disable=(not includeProgressBar)):
+            module.displayModule()
 
-            currVelocities = [x.velocity[0] for x in module.bandoliers[-1].cells]
-            maxVelocity = max(np.absolute(currVelocities))
-           
-            finalBandoVelocities.append(currVelocities)
+    module.simulated = True
 
-            if (numberOfSimSteps < 0):
-                if (maxVelocity < modelParameters.MODEL_MIN_VELOCITY):
-                    countInTreshold+=1
-                else:
-                    countInTreshold = 0
-                
-                
-                if (countInTreshold >= modelParameters.MODEL_IN_VELOCITY_THRESHOLD_COUNT):
-                    stable = True
-                    break
-            module.space.step(stepDt)
+    return stable
 
+# Step the simulation until the watched bandolier is stable (or for numberOfSimSteps if it is positive), or until the
+# detector's monitor gives up on it (detector.abortReason is set). simulatedBandos are the dynamic bandoliers being
+# simulated, and every step is passed to the recorder (if given). Returns the stability, number of steps taken and
+# simulated time
+def stepSimulation(module:components.Module, watchedBando:components.Bandolier, simulatedBandos:List[components.Bandolier], detector:ConvergenceDetector, numberOfSimSteps:int=-1, simulationTitle="", includeProgressBar=True, progressBarLeave=True, recorder:TrajectoryRecorder=None) -> Tuple[bool, int, float]:
+    detector.reset()
+    detector.watch([body for bando in simulatedBandos for body in bando.getDynamicBodies()])
+    stepper = createStepper(module.modelParams, simulatedBandos)
 
-        if (displayFigure):
-            
-            stableString = "Stability Ignored" if numberOfSimSteps > 0 else str(stable)
+    stable = False
+    maxSteps = modelParameters.MODEL_MAX_STEPS if numberOfSimSteps < 0 else numberOfSimSteps
+    maxSimulatedTime = maxSteps*module.modelParams.MODEL_STEP_DT # same simulated time budget whether stepping is adaptive or not
+    stepCount = 0
+    simulatedTime = 0
 
-            plt.figure()
-            plt.title(f"Maximum Velocity of final Bando, Stable: {stableString}")
-            plt.xlabel("Simulation Step Count")
-            plt.ylabel("Maximum cell x velocity")
-            plt.plot([max(x) for x in finalBandoVelocities])         
-            
+    # phase times are summed locally and only recorded once the simulation is over
+    profile = profiling.enabled()
+    checkTime = 0.0
+    stepTime = 0.0
 
-            module.displayModule()
+    for x in tqdm(range(maxSteps), desc=simulationTitle, leave=progressBarLeave, unit="step", disable=(not includeProgressBar)):
+        if (profile):
+            checkStart = time.perf_counter()
 
-    module.simulated = True
+        converged = detector.update(watchedBando.getXVelocities())
 
-    return stable
+        if (profile):
+            checkTime += time.perf_counter()-checkStart
+
+        if (numberOfSimSteps < 0 and converged):
+            stable = True
+            break
+
+        if (numberOfSimSteps < 0 and detector.abortReason):
+            break
+
+        if (simulatedTime >= maxSimulatedTime):
+            break
+
+        stepDt = stepper.nextDt(module)
+        if (profile):
+            stepStart = time.perf_counter()
+
+        module.space.step(stepDt)
+
+        if (profile):
+            stepTime += time.perf_counter()-stepStart
+
+        if (recorder is not None):
+            recorder.update(module, stepDt)
+
+        stepCount += 1
+        simulatedTime += stepDt
+
+    if (profile):
+        profiling.addTime("convergenceCheck", checkTime, stepCount+1)
+        profiling.addTime("spaceStep", stepTime, stepCount)
+
+    return (stable, stepCount, simulatedTime)
+
+# Sequential engine: bandoliers are added to the space one at a time, settled against the already settled (and
+# frozen) stack, then frozen themselves. Only a single bandolier is dynamic at any time. The module is stable if
+# every bandolier reached stability. If a bandolier's simulation is aborted the rest are not simulated. Returns the
+# stability and the concatenated velocity history (if kept)
+def simulateSequentially(module:components.Module, detector:ConvergenceDetector, numberOfSimSteps:int=-1, simulationTitle="", includeProgressBar=True, progressBarLeave=True, recorder:TrajectoryRecorder=None) -> Tuple[bool, Optional[List[float]]]:
+    dynamicBandos = [bando for bando in module.bandoliers if not bando.static]
+    velocityHistory = [] if detector.keepHistory else None
+
+    for bando in dynamicBandos:
+        bando.removeFromSpace()
+
+    stable = True
+    module.simulationSteps = 0
+    module.simulatedTime = 0
+    module.sleepingBodies = 0
+    module.firstSleepStep = -1
+    module.allAsleepStep = -1
+    module.abortReason = ""
+
+    for bando in tqdm(dynamicBandos, desc=simulationTitle, leave=progressBarLeave, unit="bandolier", disable=(not includeProgressBar)):
+        bando.addToSpace()
+
+        bandoStable, steps, simulatedTime = stepSimulation(module, bando, [bando], detector, numberOfSimSteps, includeProgressBar=False, recorder=recorder)
+
+        stable = stable and bandoStable
+
+        # sleep steps are counted from the start of the whole simulation
+        module.sleepingBodies += detector.sleepingBodies
+        if (module.firstSleepStep < 0 and detector.firstSleepStep >= 0):
+            module.firstSleepStep = module.simulationSteps + detector.firstSleepStep
+        module.allAsleepStep = module.simulationSteps + detector.allAsleepStep if detector.allAsleepStep >= 0 else -1
+
+        module.simulationSteps += steps
+        module.simulatedTime += simulatedTime
+        if (velocityHistory is not None):
+            velocityHistory.extend(detector.history)
+
+        bando.freeze()
+
+        if (detector.abortReason):
+            module.abortReason = detector.abortReason
+            break
+
+    return (stable, velocityHistory)
+
+# Analytics of a simulated module, at the given level (ANALYTICS_LEVEL if not given, see analytics.py). Cell positions
+# are read from the module once
+def simulationAnalytics(module:components.Module, stable:bool, level:str=None):
+    positions = module.getPositions()
+    diameters = module.getDiameters()
+    lowerDistances, upperDistances = module.getLimitDistances()
 
-def simulationAnalytics(module:components.Module, stable:bool):
     analytics = {
                     "stable":stable,
-                    "totalModuleWidth":module.getTotalWidth(),
+                    "totalModuleWidth":components.moduleWidth(positions[..., 0], diameters) if module.simulated else -1,
+                    "simulationSteps":module.simulationSteps,
+                    "simulatedTime":module.simulatedTime,
+                    "sleepingBodies":module.sleepingBodies,
+                    "firstSleepStep":module.firstSleepStep,
+                    "allAsleepStep":module.allAsleepStep,
+                    "abortReason":module.abortReason,
                     "bandoliers":[]
                 }
 
-    for bandolier in module.bandoliers:
-        upperDistance = bandolier.distanceFromUpperLimit()
-        lowerDistance = bandolier.distanceFromLowerLimit()
+    for upperDistance, lowerDistance in zip(upperDistances.tolist(), lowerDistances.tolist()):
         bandoAnalysis = {
                             "upperDistanceX":upperDistance[0],
                             "upperDistanceY":upperDistance[1],
@@ -131,7 +212,45 @@ def simulationAnalytics(module:components.Module, stable:bool):
 
         analytics["bandoliers"].append(bandoAnalysis)
 
-    return analytics
+    return moduleAnalytics.addDetailedAnalytics(analytics, positions, diameters, module.modelParams, level)
+
+# Compact and picklable result of a single simulation, returned by workers instead of the whole module. Holds the
+# analytics and, in float32, the final pose of every bandolier body and the cell diameters (about 25kB for the
+# default module), which is enough to rebuild the simulated module for display
+@dataclass
+class SimulationRecord:
+    analytics:Dict[str, Any]
+    modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS
+    bodyStates:Optional[np.ndarray] = None # (bandolier, body, [x, y, angle]), bodies ordered as in Bandolier.getDynamicBodies()
+    diameters:Optional[np.ndarray] = None # (bandolier, cell)
+    seed:Optional[int] = None # iteration seed the module tolerances were sampled with (see seeding.py)
+    trajectoryFile:Optional[str] = None # trajectory of the simulation, if it was recorded (see trajectory.py)
+
+    @property
+    def totalModuleWidth(self) -> float:
+        return self.analytics["totalModuleWidth"]
+
+    # Rebuild the module in its final simulated state (for displayModule). Joints are not valid in the rebuilt
+    # module, so it should not be simulated further. Returns None if no body states were recorded
+    def toModule(self) -> Optional[components.Module]:
+        if (self.bodyStates is None):
+            return None
+
+        tolerances = [(np.zeros(len(diameters)), np.zeros(len(diameters)), diameters.astype(float)) for diameters in self.diameters]
+        module = components.Module(modelParams=self.modelParams, tolerances=tolerances)
+        module.setBodyStates(self.bodyStates.astype(float))
+        module.simulated = True
+
+        return module
+
+def simulationRecord(module:components.Module, stable:bool, seed:Optional[int] = None) -> SimulationRecord:
+    bodyStates = module.getBodyStates().astype(np.float32)
+    diameters = np.stack([bando.diameters for bando in module.bandoliers]).astype(np.float32)
+
+    with profiling.timer("analytics"):
+        analytics = simulationAnalytics(module, stable)
+
+    return SimulationRecord(analytics, module.modelParams, bodyStates, diameters, seed)
 
 if __name__ == "__main__":
     m = components.Module()
@@ -0,0 +1,100 @@
+###############
+# stepping.py
+# TOM WRIGHT 2021
+###############
+
+"""
+Time step controllers used by simulateModule. The fixed stepper reproduces the original behaviour of stepping the
+space by MODEL_STEP_DT every step. The adaptive stepper takes large steps while the bandoliers are still falling
+towards each other, limiting each step so that the closest pair of neighbouring bandoliers can only close a fraction
+of the remaining gap between them. Once any pair is in contact the smallest step is used for the rest of the
+simulation: contact is not re-checked, and the step does not shrink gradually as the watched velocity approaches
+MODEL_MIN_VELOCITY. Bandoliers only settle after touching, so the stability criterion is always evaluated at the
+smallest step, as in the fixed step simulation (with the default MODEL_ADAPTIVE_DT_MIN of MODEL_STEP_DT).
+"""
+
+from typing import List, Optional
+
+import numpy as np
+
+import components
+import modelParameters
+
+
+class FixedStepper:
+    def __init__(self, modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS) -> None:
+        self.dt:float = modelParams.MODEL_STEP_DT
+
+    def nextDt(self, module:components.Module) -> float:
+        return self.dt
+
+
+# Steps the simulation of bandoliers (all the dynamic bandoliers of the module if not given). Only the gaps between
+# each of them and the bandolier before it are measured, so the frozen stack of the sequential engine is left out
+class AdaptiveStepper:
+    def __init__(self, modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS, bandoliers:Optional[List[components.Bandolier]] = None) -> None:
+        self.dtMin:float = modelParams.MODEL_ADAPTIVE_DT_MIN
+        self.dtMax:float = max(modelParams.MODEL_ADAPTIVE_DT_MAX, self.dtMin)
+        self.contactDistance:float = modelParams.MODEL_ADAPTIVE_CONTACT_DISTANCE
+        self.approachFraction:float = modelParams.MODEL_ADAPTIVE_MAX_APPROACH_FRACTION
+        self.checkInterval:int = max(1, modelParams.MODEL_ADAPTIVE_CHECK_INTERVAL)
+        self.minVelocity:float = modelParameters.MODEL_MIN_VELOCITY
+        self.ids:Optional[List[int]] = None if bandoliers is None else [bando.id for bando in bandoliers if bando.id > 0]
+
+        self.steps:int = 0
+        self.clearance:float = np.inf
+        self.speed:float = 0
+        self.inContact:bool = False
+
+    # Closest gap below the simulated bandoliers, and the speed it can close at: the fastest cell of each of the two
+    # bandoliers. The static first bandolier and frozen bandoliers do not move (pymunk does not keep the velocity
+    # of static bodies, so it is not read)
+    def measure(self, module:components.Module) -> None:
+        clearances = module.getNeighbourClearances(self.ids)
+        if (len(clearances) == 0):
+            self.clearance = np.inf
+            return
+
+        pair = int(np.argmin(clearances))
+        upper = self.ids[pair] if self.ids is not None else pair+1
+        self.clearance = float(clearances[pair])
+        self.speed = sum(float(np.hypot(*bando.getVelocities().T).max()) for bando in module.bandoliers[upper-1:upper+1] if not (bando.static or bando.frozen))
+
+    def nextDt(self, module:components.Module) -> float:
+        # once touching, bandoliers stay in contact so the clearance no longer needs checking
+        if (not self.inContact and self.steps % self.checkInterval == 0):
+            self.measure(module)
+        self.steps += 1
+
+        self.inContact = self.inContact or self.clearance <= self.contactDistance
+
+        if (self.inContact):
+            return self.dtMin
+
+        # a step may only close part of the remaining gap (the pair closes it at most at their speed plus what gravity
+        # adds during the step)
+        speed = max(self.speed, self.minVelocity)
+        gravity = abs(module.space.gravity[0])
+        allowedDistance = self.approachFraction*(self.clearance-self.contactDistance)
+
+        # solve speed*dt + gravity*dt^2 = allowedDistance for dt
+        dt = 2*allowedDistance/(speed + np.sqrt(speed**2 + 4*gravity*allowedDistance))
+
+        dt = float(np.clip(dt, self.dtMin, self.dtMax))
+
+        # assume the worst case approach until the clearance is next measured
+        self.clearance -= speed*dt + gravity*dt**2
+        self.speed = speed + 2*gravity*dt
+
+        return dt
+
+
+def createStepper(modelParams:modelParameters.ModelParams = modelParameters.DEFAULT_PARAMETERS, bandoliers:Optional[List[components.Bandolier]] = None):
+    if (modelParams.MODEL_ADAPTIVE_STEPPING):
+        return AdaptiveStepper(modelParams, bandoliers)
+
+    return FixedStepper(modelParams)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,160 @@
+###############
+# stopping.py
+# TOM WRIGHT 2021
+###############
+
+"""
+Sequential stopping of monte-carlo runs. Instead of a fixed number of iterations, iterations keep being submitted
+until a statistic of the module width has converged: the confidence interval of the estimate (at the given
+confidence level) must be narrower than +/- the tolerance. The statistic can be the mean (normal interval), a
+quantile such as "p95" (distribution free interval from order statistics) or "max", the MODEL_STOPPING_MAX_QUANTILE
+tail of the distribution (the sample maximum itself never converges). runSequentially() schedules the iterations of
+many designs on a pool, always submitting the next iteration of the design that has had the fewest, so designs
+that converge early leave the workers to the ones that have not.
+"""
+
+import os
+import queue
+from collections import deque
+from multiprocessing.pool import Pool
+from statistics import NormalDist
+from typing import Any, Callable, Deque, List, Optional, Set
+
+import numpy as np
+
+import modelParameters
+
+
+# Quantile of a statistic name ("pNN" or "max"), None for the mean
+def statisticQuantile(statistic:str) -> Optional[float]:
+    if (statistic == "mean"):
+        return None
+    if (statistic == "max"):
+        return modelParameters.MODEL_STOPPING_MAX_QUANTILE
+    if (statistic.startswith("p")):
+        try:
+            quantile = float(statistic[1:])/100
+        except ValueError:
+            quantile = -1
+        if (0 < quantile < 1):
+            return quantile
+
+    raise ValueError(f"Unknown stopping statistic {statistic}, expected mean, max or a percentile such as p95")
+
+
+class StoppingRule:
+    def __init__(self, statistic:str = modelParameters.MODEL_STOPPING_STATISTIC, tolerance:float = modelParameters.MODEL_STOPPING_TOLERANCE, confidence:float = modelParameters.MODEL_STOPPING_CONFIDENCE, minIterations:int = modelParameters.MODEL_STOPPING_MIN_ITERATIONS, maxIterations:int = modelParameters.MODEL_STOPPING_MAX_ITERATIONS) -> None:
+        self.statistic:str = statistic
+        self.quantile:Optional[float] = statisticQuantile(statistic)
+        self.tolerance:float = tolerance
+        self.z:float = NormalDist().inv_cdf((1+confidence)/2)
+        self.minIterations:int = max(2, minIterations)
+        self.maxIterations:int = max(1, maxIterations)
+
+        self.values:List[float] = []
+
+    def add(self, value:float) -> None:
+        self.values.append(value)
+
+    @property
+    def count(self) -> int:
+        return len(self.values)
+
+    def estimate(self) -> float:
+        if (self.count == 0):
+            return np.nan
+        if (self.quantile is None):
+            return float(np.mean(self.values))
+
+        return float(np.quantile(self.values, self.quantile))
+
+    # Half width of the confidence interval of the estimate (inf while there are too few values to bound it)
+    def halfWidth(self) -> float:
+        n = self.count
+        if (n < 2):
+            return np.inf
+        if (self.quantile is None):
+            return float(self.z*np.std(self.values, ddof=1)/np.sqrt(n))
+
+        # ranks of the order statistics bounding the quantile, from the normal approximation to the binomial
+        spread = self.z*np.sqrt(n*self.quantile*(1-self.quantile))
+        lower = int(np.floor(n*self.quantile - spread))
+        upper = int(np.ceil(n*self.quantile + spread))
+        if (lower < 1 or upper > n):
+            return np.inf
+
+        ordered = np.sort(self.values)
+
+        return float(ordered[upper-1]-ordered[lower-1])/2
+
+    def converged(self) -> bool:
+        return self.count >= self.minIterations and self.halfWidth() <= self.tolerance
+
+    def finished(self) -> bool:
+        return self.count >= self.maxIterations or self.converged()
+
+    def summary(self) -> str:
+        return f"{self.statistic} {self.estimate():.3f} ± {self.halfWidth():.3f}mm after {self.count} iterations"
+
+
+# Run worker(makeTask(design, iteration)) on the pool for every design until its stopping rule is finished.
+# onResult(design, result) is called in this process for every result and returns the value to add to the
+# design's rule (None to leave the result out, eg. unstable results). At most maxInFlight tasks are queued at once,
+# and iterations in completedIterations[design] are skipped (from a resumed run). Tasks that are still running when
+# a design converges are completed and passed to onResult, but not added to its rule. If ready is given, a task is
+# only submitted once ready(design, iteration) is true (eg. once a task it depends on has completed)
+def runSequentially(pool:Pool, worker:Callable[[Any], Any], makeTask:Callable[[int, int], Any], rules:List[StoppingRule], onResult:Callable[[int, Any], Optional[float]], maxInFlight:int = None, completedIterations:List[Set[int]] = None, progressBar:Any = None, ready:Callable[[int, int], bool] = None) -> None:
+    if (maxInFlight is None):
+        maxInFlight = 2*(os.cpu_count() or 1)
+    if (completedIterations is None):
+        completedIterations = [set() for _ in rules]
+
+    results:queue.Queue = queue.Queue()
+    inFlight = [0]*len(rules)
+    submitted = [0]*len(rules)
+    remaining:List[Deque[int]] = [deque(i for i in range(rule.maxIterations) if i not in completedIterations[design]) for design, rule in enumerate(rules)]
+
+    def unfinished() -> List[int]:
+        return [design for design, rule in enumerate(rules) if len(remaining[design]) > 0 and not rule.finished() and rule.count + inFlight[design] < rule.maxIterations]
+
+    def nextDesign() -> Optional[int]:
+        candidates = [design for design in unfinished() if ready is None or ready(design, remaining[design][0])]
+        if (len(candidates) == 0):
+            return None
+
+        return min(candidates, key=lambda design: submitted[design])
+
+    while (True):
+        while (sum(inFlight) < maxInFlight):
+            design = nextDesign()
+            if (design is None):
+                break
+
+            iteration = remaining[design].popleft()
+
+            pool.apply_async(worker, (makeTask(design, iteration),),
+                             callback=lambda result, design=design: results.put((design, result, None)),
+                             error_callback=lambda error, design=design: results.put((design, None, error)))
+            inFlight[design] += 1
+            submitted[design] += 1
+
+        if (sum(inFlight) == 0):
+            if (len(unfinished()) > 0):
+                raise RuntimeError("Tasks are waiting on tasks that are never run")
+            break
+
+        design, result, error = results.get()
+        inFlight[design] -= 1
+        if (error is not None):
+            raise error
+
+        value = onResult(design, result)
+        if (value is not None and not rules[design].finished()):
+            rules[design].add(value)
+
+        if (progressBar is not None):
+            progressBar.update(1)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,217 @@
+###############
+# surrogate.py
+# TOM WRIGHT 2021
+###############
+
+"""
+This file can be run independantly (trains on the multiModel results store and prints a prediction).
+Surrogate model of the module simulation, trained on the results written by multiModel.py. Result rows are grouped
+by design point (the ModelParams fields of the row), and for each output (totalModuleWidth and every bandolier
+limit distance) the mean and spread over the monte-carlo iterations of each design point are computed. Gaussian
+process regression is then used to predict the mean and spread of each output at unseen design points, along with
+the uncertainty of the prediction. Where the uncertainty is too high, or the design point changes a parameter that
+every result shares, predictOrSimulate() falls back to running the real simulation (and adds the result to the
+training data).
+"""
+
+from dataclasses import asdict, fields
+from typing import Any, Dict, List, Tuple, Union
+
+import numpy as np
+
+import modelParameters
+import resultsWriter
+from model import worker
+from multiModel import resultRow
+
+# Outputs that are modelled (bandolier limit distances are added per bandolier)
+SURROGATE_OUTPUTS = ["totalModuleWidth"]
+BANDO_OUTPUTS = ["upperDistanceX", "upperDistanceY", "lowerDistanceX", "lowerDistanceY"]
+
+# Log spaced length scales (in standardised input units) searched when fitting the gaussian processes
+LENGTH_SCALES = np.logspace(-1, 1.5, 12)
+
+
+# Gaussian process with a squared exponential kernel on standardised inputs. The mean is a least squares linear
+# trend in the inputs (a constant if there are too few points), so linear effects extrapolate sensibly
+class GaussianProcess:
+    def __init__(self, lengthScale:float = 1, signalVariance:float = 1) -> None:
+        self.lengthScale:float = lengthScale
+        self.signalVariance:float = signalVariance
+
+    def kernel(self, a:np.ndarray, b:np.ndarray) -> np.ndarray:
+        squaredDistances = ((a[:, None, :] - b[None, :, :])**2).sum(axis=-1)
+
+        return self.signalVariance*np.exp(-0.5*squaredDistances/self.lengthScale**2)
+
+    # noiseVariance is the variance of each observation (eg. the variance of a mean over monte-carlo iterations)
+    def fit(self, x:np.ndarray, y:np.ndarray, noiseVariance:np.ndarray) -> float:
+        self.x = x
+        self.useTrend:bool = len(y) > x.shape[1]+1
+        self.trend = np.linalg.lstsq(self.trendBasis(x), y, rcond=None)[0]
+        residuals = y - self.trendBasis(x) @ self.trend
+
+        covariance = self.kernel(x, x) + np.diag(noiseVariance + 1e-9*self.signalVariance)
+        self.cholesky = np.linalg.cholesky(covariance)
+        self.alpha = np.linalg.solve(self.cholesky.T, np.linalg.solve(self.cholesky, residuals))
+
+        # log marginal likelihood of the fit
+        return -0.5*residuals @ self.alpha - np.log(np.diag(self.cholesky)).sum() - 0.5*len(y)*np.log(2*np.pi)
+
+    def trendBasis(self, x:np.ndarray) -> np.ndarray:
+        if (self.useTrend):
+            return np.hstack([np.ones((len(x), 1)), x])
+
+        return np.ones((len(x), 1))
+
+    # Returns the predicted mean and its standard deviation
+    def predict(self, x:np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        crossCovariance = self.kernel(x, self.x)
+        mean = self.trendBasis(x) @ self.trend + crossCovariance @ self.alpha
+
+        v = np.linalg.solve(self.cholesky, crossCovariance.T)
+        variance = np.maximum(self.signalVariance - (v**2).sum(axis=0), 0)
+
+        return (mean, np.sqrt(variance))
+
+# Fit a gaussian process, choosing the length scale with the highest marginal likelihood
+def fitGaussianProcess(x:np.ndarray, y:np.ndarray, noiseVariance:np.ndarray) -> GaussianProcess:
+    signalVariance = max(y.var(), 1e-12)
+    bestProcess, bestLikelihood = None, -np.inf
+
+    for lengthScale in LENGTH_SCALES:
+        process = GaussianProcess(lengthScale, signalVariance)
+        try:
+            likelihood = process.fit(x, y, noiseVariance)
+        except np.linalg.LinAlgError:
+            continue
+
+        if (likelihood > bestLikelihood):
+            bestProcess, bestLikelihood = process, likelihood
+
+    return bestProcess
+
+# Read the rows of a multiModel results store
+def loadResults(storeName:str = resultsWriter.RESULTS_STORE_NAME) -> List[Dict[str, Any]]:
+    return resultsWriter.loadRows(storeName)
+
+# Sort the ModelParams fields of result rows into inputs (the numeric fields that vary between rows) and fixed
+# inputs (the fields with a single value, with that value). Other fields can not be modelled, so they may not vary
+def classifyInputs(rows:List[Dict[str, Any]]) -> Tuple[List[str], Dict[str, Any]]:
+    inputs = []
+    fixedInputs = {}
+    for name in [field.name for field in fields(modelParameters.ModelParams) if field.name in rows[0]]:
+        values = set(row[name] for row in rows)
+        if (len(values) == 1):
+            fixedInputs[name] = rows[0][name]
+        elif (all(isinstance(value, (bool, float, int)) for value in values)):
+            inputs.append(name)
+        else:
+            raise ValueError(f"{name} varies between results but is not numeric, so it can not be a surrogate input")
+
+    return (inputs, fixedInputs)
+
+
+class Surrogate:
+    def __init__(self, rows:List[Dict[str, Any]], outputs:List[str] = None) -> None:
+        if (modelParameters.DISCARD_UNSTABLE_RESULTS):
+            rows = [row for row in rows if row["stable"]]
+
+        if (len(rows) == 0):
+            raise ValueError("No results to train the surrogate on")
+
+        if (outputs is None):
+            outputs = SURROGATE_OUTPUTS + [key for key in rows[0].keys() if key.startswith("Bando") and key.split("_")[-1] in BANDO_OUTPUTS]
+        self.outputs:List[str] = outputs
+
+        self.rows:List[Dict[str, Any]] = []
+        self.addResults(rows)
+
+    # Add result rows and refit every output. The inputs are chosen again, as the new rows can vary a parameter that
+    # was fixed
+    def addResults(self, rows:List[Dict[str, Any]]) -> None:
+        if (modelParameters.DISCARD_UNSTABLE_RESULTS):
+            rows = [row for row in rows if row["stable"]]
+
+        self.inputs, self.fixedInputs = classifyInputs(self.rows + rows)
+        self.rows.extend(rows)
+
+        # group rows by design point
+        designs:Dict[Tuple[float, ...], List[Dict[str, Any]]] = {}
+        for row in self.rows:
+            designs.setdefault(tuple(float(row[name]) for name in self.inputs), []).append(row)
+
+        designPoints = np.array(list(designs.keys())).reshape(len(designs), len(self.inputs))
+        self.inputMean = designPoints.mean(axis=0)
+        self.inputScale = np.where(designPoints.std(axis=0) > 0, designPoints.std(axis=0), 1)
+        x = self.standardise(designPoints)
+        counts = np.array([len(designRows) for designRows in designs.values()])
+
+        self.meanModels:Dict[str, GaussianProcess] = {}
+        self.spreadModels:Dict[str, GaussianProcess] = {}
+        for output in self.outputs:
+            values = [np.array([row[output] for row in designRows], dtype=float) for designRows in designs.values()]
+            means = np.array([x.mean() for x in values])
+            variances = np.array([x.var(ddof=1) if len(x) > 1 else np.nan for x in values])
+
+            # designs with a single iteration use the average spread of the other designs
+            pooledVariance = np.nanmean(variances) if np.any(np.isfinite(variances)) else 0
+            variances = np.where(np.isfinite(variances), variances, pooledVariance)
+            self.meanModels[output] = fitGaussianProcess(x, means, variances/counts)
+
+            # the spread is modelled as log standard deviation, whose sampling variance is about 1/(2(n-1))
+            multiple = counts > 1
+            if (np.any(multiple) and np.all(variances[multiple] > 0)):
+                logSpread = 0.5*np.log(variances[multiple])
+                self.spreadModels[output] = fitGaussianProcess(x[multiple], logSpread, 1/(2*(counts[multiple]-1)))
+
+    def standardise(self, designPoints:np.ndarray) -> np.ndarray:
+        return (designPoints - self.inputMean)/self.inputScale
+
+    # Fixed inputs whose value at a design point differs from the value every result was simulated with
+    def differingInputs(self, modelInputs:Union[Dict[str, Any], modelParameters.ModelParams]) -> List[str]:
+        if (isinstance(modelInputs, modelParameters.ModelParams)):
+            modelInputs = asdict(modelInputs)
+
+        return [name for name, value in self.fixedInputs.items() if modelInputs.get(name, value) != value]
+
+    # Predict every output at a design point. Returns {output: (mean, uncertainty of mean, spread)}. Raises a
+    # ValueError if the design point differs in a fixed input, as the surrogate knows nothing of its effect
+    def predict(self, modelInputs:Union[Dict[str, Any], modelParameters.ModelParams]) -> Dict[str, Tuple[float, float, float]]:
+        if (isinstance(modelInputs, modelParameters.ModelParams)):
+            modelInputs = asdict(modelInputs)
+
+        differing = self.differingInputs(modelInputs)
+        if (differing):
+            raise ValueError(f"Can not predict a design point that differs from every result in {', '.join(differing)}")
+
+        x = self.standardise(np.array([[float(modelInputs[name]) for name in self.inputs]]))
+
+        predictions = {}
+        for output in self.outputs:
+            mean, uncertainty = self.meanModels[output].predict(x)
+            spread = np.exp(self.spreadModels[output].predict(x)[0][0]) if output in self.spreadModels else 0.0
+            predictions[output] = (float(mean[0]), float(uncertainty[0]), float(spread))
+
+        return predictions
+
+    # Predict at a design point, falling back to running numIterations simulations if the uncertainty of the mean
+    # module width is above maxUncertainty (mm), or the design point differs in a fixed input. Simulated results are
+    # added to the surrogate
+    def predictOrSimulate(self, modelParams:modelParameters.ModelParams, maxUncertainty:float, numIterations:int = modelParameters.MODEL_NUM_ITERATIONS) -> Tuple[Dict[str, Tuple[float, float, float]], bool]:
+        if (not self.differingInputs(modelParams)):
+            predictions = self.predict(modelParams)
+
+            if (predictions["totalModuleWidth"][1] <= maxUncertainty):
+                return (predictions, False)
+
+        self.addResults([resultRow(asdict(modelParams), worker(i, modelParams).analytics) for i in range(numIterations)])
+
+        return (self.predict(modelParams), True)
+
+
+if __name__ == "__main__":
+    surrogate = Surrogate(loadResults())
+
+    for output, (mean, uncertainty, spread) in surrogate.predict(modelParameters.DEFAULT_PARAMETERS).items():
+        print(f"{output}: {mean:.3f} ± {uncertainty:.3f} (spread {spread:.3f})")
@@ -0,0 +1,242 @@
+###############
+# trajectory.py
+# TOM WRIGHT 2021
+###############
+
+"""
+This file can be run independantly, to replay a recorded simulation:
+    python trajectory.py FILE
+    python trajectory.py --pick largest|smallest [--seed ROOT_SEED | --directory DIRECTORY]
+Recording and replay of how a module settles, without animating the simulation live. While a simulation runs, a
+TrajectoryRecorder writes the (x, y, angle) of every bandolier body every TRAJECTORY_INTERVAL steps (and the final
+step) to a memory-mapped float32 .npy file, shaped (frame, bandolier, body, 3). A .json file beside it holds the
+frame steps and times, the model parameters, cell diameters, seed and the summary analytics of the simulation.
+model.py records every simulation when TRAJECTORY_RECORDING is set, so any outlier of a run (eg. the largest and
+smallest modules) can be replayed afterwards (see visualisation.animateTrajectory). Each run records to its own
+directory, named after its root seed (see runDirectory), which is cleared when the run starts. --pick picks from the
+run of the given root seed, or the most recent run. Recorded frames are read back
+memory-mapped, so they are not copied into memory until they are drawn.
+"""
+
+import argparse
+import glob
+import json
+import os
+import struct
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+import components
+import modelParameters
+
+TRAJECTORY_PATTERN = "*.npy"
+
+NPY_PREAMBLE_LENGTH = 10 # magic string, version and header length of a version 1.0 .npy file
+
+
+# Largest number of steps a simulation of the module for numberOfSimSteps (or until stable if negative) can take (see
+# simulation.stepSimulation)
+def maxSimulationSteps(module:components.Module, numberOfSimSteps:int = -1) -> int:
+    maxSteps = modelParameters.MODEL_MAX_STEPS if numberOfSimSteps < 0 else numberOfSimSteps
+    if (module.modelParams.SIMULATION_ENGINE == modelParameters.ENGINE_SEQUENTIAL):
+        return maxSteps*len([bando for bando in module.bandoliers if not bando.static])
+
+    return maxSteps
+
+# Directory the trajectories of the run with a root seed are recorded to
+def runDirectory(rootSeed:int, directory:str = modelParameters.TRAJECTORY_DIRECTORY) -> str:
+    return os.path.join(directory, f"run_{rootSeed}")
+
+# Most recently recorded run directory of a directory
+def latestRunDirectory(directory:str = modelParameters.TRAJECTORY_DIRECTORY) -> str:
+    runDirectories = [path for path in glob.glob(runDirectory("*", directory)) if os.path.isdir(path)]
+    if (len(runDirectories) == 0):
+        raise FileNotFoundError(f"No recorded runs in {directory}")
+
+    return max(runDirectories, key=os.path.getmtime)
+
+# Remove the trajectories recorded to a directory, so a new run does not mix with an older one
+def clearTrajectories(directory:str) -> None:
+    for fileName in glob.glob(os.path.join(directory, TRAJECTORY_PATTERN)):
+        os.remove(fileName)
+        if (os.path.exists(metadataFileName(fileName))):
+            os.remove(metadataFileName(fileName))
+
+def metadataFileName(fileName:str) -> str:
+    return os.path.splitext(fileName)[0] + ".json"
+
+# Shrink a .npy file of frames to its first frameCount frames. Its header is rewritten with the new shape (padded to
+# the same length, so the data does not move) and the unused frames are cut off the end of the file
+def truncateFrames(fileName:str, frameCount:int) -> None:
+    with open(fileName, 'r+b') as file:
+        version = np.lib.format.read_magic(file)
+        if (version != (1, 0)):
+            raise ValueError(f"Unsupported .npy version {version} of {fileName}")
+
+        shape, _, dtype = np.lib.format.read_array_header_1_0(file)
+        dataOffset = file.tell()
+
+        shape = (frameCount, *shape[1:])
+        header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (np.lib.format.dtype_to_descr(dtype), shape)
+        header = header.ljust(dataOffset-NPY_PREAMBLE_LENGTH-1) + "\n"
+
+        file.seek(NPY_PREAMBLE_LENGTH-2)
+        file.write(struct.pack("<H", len(header)) + header.encode("latin1"))
+        file.truncate(dataOffset + int(np.prod(shape))*dtype.itemsize)
+
+
+# Writes the trajectory of a module's simulation to fileName while it is simulated. Pass it to simulateModule (with the
+# same numberOfSimSteps), then close() it once the simulation is over
+class TrajectoryRecorder:
+    def __init__(self, fileName:str, module:components.Module, numberOfSimSteps:int = -1, interval:int = modelParameters.TRAJECTORY_INTERVAL) -> None:
+        self.fileName:str = fileName
+        self.interval:int = max(1, interval)
+        self.stepCount:int = 0
+        self.simulatedTime:float = 0
+        self.frameCount:int = 0
+        self.steps:List[int] = []
+        self.times:List[float] = []
+
+        # room for every interval'th step of the longest possible simulation, plus the first and last steps
+        capacity = maxSimulationSteps(module, numberOfSimSteps)//self.interval + 2
+        directory = os.path.dirname(fileName)
+        if (directory):
+            os.makedirs(directory, exist_ok=True)
+        self.frames:Optional[np.memmap] = np.lib.format.open_memmap(fileName, mode="w+", dtype=np.float32, shape=(capacity, *module.getBodyStates().shape))
+
+        self.record(module)
+
+    # Called after every simulation step of dt seconds
+    def update(self, module:components.Module, dt:float) -> None:
+        self.stepCount += 1
+        self.simulatedTime += dt
+
+        if (self.stepCount % self.interval == 0):
+            self.record(module)
+
+    def record(self, module:components.Module) -> None:
+        if (self.frameCount >= len(self.frames)):
+            raise RuntimeError(f"The simulation took more steps than {self.fileName} has room for (was the recorder given its numberOfSimSteps?)")
+
+        self.frames[self.frameCount] = module.getBodyStates()
+        self.steps.append(self.stepCount)
+        self.times.append(self.simulatedTime)
+        self.frameCount += 1
+
+    # Record the final step, cut the file down to the recorded frames and write the metadata. Returns the file name
+    def close(self, module:components.Module, analytics:Optional[Dict[str, Any]] = None, seed:Optional[int] = None) -> str:
+        if (self.steps[-1] != self.stepCount):
+            self.record(module)
+
+        # the file can not be truncated while it is mapped
+        self.frames.flush()
+        self.frames = None
+        truncateFrames(self.fileName, self.frameCount)
+
+        summary = {name:value for name, value in (analytics or {}).items() if name not in ("bandoliers", "cells")}
+        metadata = {
+                        "interval":self.interval,
+                        "steps":self.steps,
+                        "times":self.times,
+                        "seed":seed,
+                        "modelParams":asdict(module.modelParams),
+                        "diameters":module.getDiameters().tolist(),
+                        "analytics":summary
+                    }
+
+        # design points of sweeps can hold numpy values
+        with open(metadataFileName(self.fileName), 'w') as file:
+            json.dump(metadata, file, indent=4, default=lambda value: value.item())
+
+        return self.fileName
+
+# Recorder for a model.py simulation, named after its iteration seed
+def seedRecorder(module:components.Module, seed:int, directory:str = modelParameters.TRAJECTORY_DIRECTORY) -> TrajectoryRecorder:
+    return TrajectoryRecorder(os.path.join(directory, f"seed_{seed}.npy"), module)
+
+
+# A recorded trajectory. frames is memory-mapped (read only), shaped (frame, bandolier, body, [x, y, angle])
+@dataclass
+class Trajectory:
+    fileName:str
+    frames:np.ndarray
+    steps:np.ndarray
+    times:np.ndarray
+    modelParams:modelParameters.ModelParams
+    diameters:np.ndarray # (bandolier, cell)
+    seed:Optional[int]
+    analytics:Dict[str, Any]
+
+    # Module in the state of a frame, for drawing only (joints are not moved with the bodies)
+    def toModule(self, frame:int = -1) -> components.Module:
+        tolerances = [(np.zeros(len(diameters)), np.zeros(len(diameters)), diameters) for diameters in self.diameters]
+        module = components.Module(modelParams=self.modelParams, tolerances=tolerances)
+        module.setBodyStates(self.frames[frame].astype(float))
+        module.simulated = True
+
+        return module
+
+def loadTrajectory(fileName:str) -> Trajectory:
+    with open(metadataFileName(fileName)) as file:
+        metadata = json.load(file)
+
+    return Trajectory(fileName, np.load(fileName, mmap_mode="r"), np.array(metadata["steps"]), np.array(metadata["times"]),
+                      modelParameters.ModelParams(**metadata["modelParams"]), np.array(metadata["diameters"]), metadata["seed"], metadata["analytics"])
+
+# Trajectory files in a directory (eg. a runDirectory), with the summary analytics of each
+def recordedTrajectories(directory:str) -> Dict[str, Dict[str, Any]]:
+    trajectories = {}
+    for fileName in sorted(glob.glob(os.path.join(directory, TRAJECTORY_PATTERN))):
+        if (os.path.exists(metadataFileName(fileName))):
+            with open(metadataFileName(fileName)) as file:
+                trajectories[fileName] = json.load(file)["analytics"]
+
+    return trajectories
+
+# File of the largest or smallest (pick) recorded module of a directory. Unstable modules are left out if they are
+# discarded from results (DISCARD_UNSTABLE_RESULTS)
+def pickTrajectory(pick:str, directory:str) -> str:
+    trajectories = recordedTrajectories(directory)
+    if (modelParameters.DISCARD_UNSTABLE_RESULTS):
+        trajectories = {fileName:analytics for fileName, analytics in trajectories.items() if analytics.get("stable", True)}
+
+    if (len(trajectories) == 0):
+        raise FileNotFoundError(f"No recorded trajectories in {directory}")
+
+    choose = {"largest":max, "smallest":min}[pick]
+
+    return choose(trajectories, key=lambda fileName: trajectories[fileName]["totalModuleWidth"])
+
+
+if __name__ == "__main__":
+    import visualisation
+
+    parser = argparse.ArgumentParser(description="Replay a recorded simulation")
+    parser.add_argument("file", nargs="?", default=None)
+    parser.add_argument("--pick", choices=["largest", "smallest"], default=None, help="replay the largest or smallest recorded module")
+    parser.add_argument("--seed", type=int, default=None, help="pick from the run of this root seed (the most recent run if not given)")
+    parser.add_argument("--directory", default=None, help="pick from this directory instead of a run's")
+    parser.add_argument("--frame-interval", type=int, default=20, help="ms per frame")
+    args = parser.parse_args()
+
+    if (args.file is None and args.pick is None):
+        parser.error("give a trajectory file or --pick")
+
+    if (args.file is not None):
+        fileName = args.file
+    else:
+        if (args.directory is not None):
+            directory = args.directory
+        elif (args.seed is not None):
+            directory = runDirectory(args.seed)
+        else:
+            directory = latestRunDirectory()
+        fileName = pickTrajectory(args.pick, directory)
+
+    trajectory = loadTrajectory(fileName)
+    print(f"{fileName}: {len(trajectory.frames)} frames, seed {trajectory.seed}, {trajectory.analytics}")
+
+    anim = visualisation.animateTrajectory(trajectory, f"{trajectory.analytics.get('totalModuleWidth', 0):.3f}mm (seed {trajectory.seed})", args.frame_interval)
+    visualisation.show()
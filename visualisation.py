@@ -0,0 +1,136 @@
+###############
+# visualisation.py
+# TOM WRIGHT 2021
+###############
+
+"""
+Every figure and animation of the model: modules, the live simulation animation, the velocity history of a
+simulation, histograms of module widths and the replay of recorded trajectories (see trajectory.py). The rest of
+the model does not import matplotlib, so pool workers and headless runs do not pay for it. This file is imported
+where a figure is first drawn (eg. "import visualisation" inside the function that draws it).
+"""
+
+from typing import List
+
+import matplotlib.pyplot as plt
+from matplotlib import animation
+import pymunk
+import pymunk.matplotlib_util
+
+import components
+import modelParameters
+from trajectory import Trajectory
+
+
+def drawOptions(ax, includeCollisionPoints:bool = True) -> pymunk.matplotlib_util.DrawOptions:
+    drawOption = pymunk.matplotlib_util.DrawOptions(ax)
+    drawOption.flags = pymunk.SpaceDebugDrawOptions.DRAW_SHAPES | \
+                        (pymunk.SpaceDebugDrawOptions.DRAW_COLLISION_POINTS if includeCollisionPoints else 0) | \
+                        (pymunk.SpaceDebugDrawOptions.DRAW_CONSTRAINTS if modelParameters.DISPLAY_CONSTRAINTS else 0)
+
+    return drawOption
+
+def displayModule(module:components.Module, title:str="", blocking:bool=True) -> None:
+    leftMostX, rightMostX, bottomMostY, topMostY = module.getCellBounds()
+
+    if module.modelParams.INCLUDE_END_CONSTRAINTS:
+        bottomMostY -= max(module.modelParams.END_LIMIT_LOWER_Y, module.modelParams.END_CONSTRAINT_LOWER_Y)
+        topMostY += max(module.modelParams.END_LIMIT_UPPER_Y, module.modelParams.END_CONSTRAINT_UPPER_Y)
+
+    figureXLim = (leftMostX-25, rightMostX+25)
+    figureYLim = (bottomMostY-25, topMostY+25)
+
+    fig = plt.figure()
+    ax = plt.axes(xlim=figureXLim, ylim=figureYLim)
+    plt.title(title)
+    ax.set_aspect("equal")
+
+    module.space.debug_draw(drawOptions(ax))
+
+    if (blocking):
+        plt.show()
+
+# Step the simulation live in an animation, for numberOfSimSteps (stability is not checked)
+def animateSimulation(module:components.Module, numberOfSimSteps:int) -> None:
+    def init():
+        module.space.debug_draw(drawOption)
+        return []
+
+    def animate(_):
+        ax.clear()
+        ax.set_xlim(figureXLim[0],figureXLim[1])
+        ax.set_ylim(figureYLim[0],figureYLim[1])
+
+        for x in range(stepsPerFrame):
+            module.space.step(0.001)
+
+        module.space.debug_draw(drawOption)
+
+    leftMostX, rightMostX, bottomMostY, topMostY = module.getCellBounds()
+    figureXLim = (leftMostX-25, rightMostX+25)
+    figureYLim = (bottomMostY-25, topMostY+25)
+
+    stepsPerFrame = 10
+
+    fig = plt.figure()
+    ax = plt.axes(xlim=figureXLim, ylim=figureYLim)
+    ax.set_aspect("equal")
+
+    drawOption = drawOptions(ax)
+
+    frames = numberOfSimSteps/stepsPerFrame
+    anim = animation.FuncAnimation(fig, animate, init_func=init, frames=int(frames), interval=10, blit=False, repeat=False)
+    plt.show()
+
+def plotVelocityHistory(velocityHistory:List[float], stableString:str) -> None:
+    plt.figure()
+    plt.title(f"Maximum Velocity of final Bando, Stable: {stableString}")
+    plt.xlabel("Simulation Step Count")
+    plt.ylabel("Maximum cell x velocity")
+    if (velocityHistory is not None):
+        plt.plot(velocityHistory)
+
+def showHistogram(widths:List[float]) -> None:
+    # q25, q75 = np.percentile(widths, [25, 75])
+    # bin_width = 2 * (q75 - q25) * len(widths) ** (-1/3)
+    # bins = round((max(widths) - min(widths)) / bin_width)
+
+    fig = plt.figure()
+    # plt.hist(widths, density=True, bins=bins)  # density=False would make counts
+
+    plt.hist(widths, density=True)
+    plt.ylabel('Probability')
+    plt.xlabel('Data')
+
+# Animate a recorded trajectory (see trajectory.py), frameInterval ms per frame. The animation must be kept referenced
+# until it is shown
+def animateTrajectory(trajectory:Trajectory, title:str = "", frameInterval:int = 20) -> animation.FuncAnimation:
+    module = trajectory.toModule(0)
+
+    positions = trajectory.frames[..., :len(trajectory.diameters[0]), :2]
+    figureXLim = (float(positions[..., 0].min())-25, float(positions[..., 0].max())+25)
+    figureYLim = (float(positions[..., 1].min())-25, float(positions[..., 1].max())+25)
+
+    fig = plt.figure()
+    ax = plt.axes(xlim=figureXLim, ylim=figureYLim)
+    ax.set_aspect("equal")
+
+    drawOption = drawOptions(ax, includeCollisionPoints=False)
+
+    def animate(frame):
+        ax.clear()
+        ax.set_xlim(figureXLim[0],figureXLim[1])
+        ax.set_ylim(figureYLim[0],figureYLim[1])
+        ax.set_title(f"{title} step {trajectory.steps[frame]} ({trajectory.times[frame]:.2f}s)")
+
+        module.setBodyStates(trajectory.frames[frame].astype(float))
+        module.space.debug_draw(drawOption)
+
+    return animation.FuncAnimation(fig, animate, frames=len(trajectory.frames), interval=frameInterval, blit=False, repeat=False)
+
+def show() -> None:
+    plt.show()
+
+
+if __name__ == "__main__":
+    pass